@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the classes to stop threads cooperatively.
+A thread is stopped by cancelling its token, which shuts down the
+sockets registered with the token so a thread blocked on them wakes up,
+and runs the callbacks registered with the token (e.g. to terminate a
+process the thread is waiting for). The thread checks the token between
+its steps and returns when it is cancelled.
+"""
+
+import socket
+import threading
+from typing import Callable
+
+# Time in seconds to wait for a thread to stop.
+stop_timeout = 5
+
+
+class CancellationToken:
+    """Main class for a token to cancel the work of a thread."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks: list[Callable] = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the token has been cancelled."""
+        return self.event.is_set()
+
+    def add_callback(self, callback: Callable):
+        """
+        Adds a function to be called when the token is cancelled, it is
+        called at once if the token is already cancelled.
+        :param callback: The function.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def register(self, connection: socket.socket):
+        """
+        Registers a socket to be shut down when the token is cancelled.
+        :param connection: The socket.
+        """
+        def shutdown():
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # The socket is already closed or disconnected.
+                pass
+
+        self.add_callback(shutdown)
+
+    def cancel(self):
+        """Cancels the token."""
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """
+        Waits for the token to be cancelled.
+        :param timeout: Maximum time to wait in seconds.
+        :return: Whether the token has been cancelled.
+        """
+        return self.event.wait(timeout)
+
+
+class CancellableThread(threading.Thread):
+    """A thread that is stopped by cancelling its token."""
+
+    def __init__(self, token: CancellationToken | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.token = token or CancellationToken()
+
+    def stop(self, timeout: float = stop_timeout) -> bool:
+        """
+        Cancels the token of the thread and waits for it to stop.
+        :param timeout: Maximum time to wait in seconds.
+        :return: Whether the thread has stopped.
+        """
+        # The token of a thread that has finished is not cancelled, the
+        # sockets registered with it are in use after it.
+        if self.ident is None or self.is_alive():
+            self.token.cancel()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(timeout)
+        return not self.is_alive()
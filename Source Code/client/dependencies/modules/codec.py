@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the binary codec for the messages sent between the
+server and the clients.
+Every message type has a schema made of fields, and is packed as the
+fields one after another, so unlike pickle, loading a message can only
+create the values in its schema.
+The messages and users, which are sent in lists, have fields of their
+own that pack their fixed-width parts with precompiled structs, and
+pack and unpack a list of them at once.
+"""
+
+import struct
+
+encoding = 'utf-8'
+
+
+def pack_id(value: str) -> bytes:
+    """
+    Packs the id of a user.
+    :param value: The id, a uuid string.
+    :return: Its 16 bytes.
+    """
+    # Faster than uuid.UUID for the ids made by str(uuid.uuid4()).
+    if len(value) != 36:
+        raise ValueError(f'Invalid id: {value!r}')
+    return bytes.fromhex(value.replace('-', ''))
+
+
+def unpack_id(value: bytes) -> str:
+    """
+    Unpacks the id of a user.
+    :param value: Its 16 bytes.
+    :return: The id, a uuid string.
+    """
+    value = value.hex()
+    return f'{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}'
+
+
+class Field:
+    """Base class for the fields of a schema."""
+
+    def pack(self, value, parts: list):
+        """
+        Packs a value of the field.
+        :param value: The value to pack.
+        :param parts: List the packed parts of the value are added to.
+        """
+        raise NotImplementedError
+
+    def unpack(self, data: bytes, offset: int) -> tuple:
+        """
+        Unpacks a value of the field.
+        :param data: The packed data.
+        :param offset: Offset of the value in the data.
+        :return: The value and the offset after the value.
+        """
+        raise NotImplementedError
+
+    def pack_all(self, values: list, parts: list):
+        """
+        Packs a list of values of the field, see List.
+        :param values: The values to pack.
+        :param parts: List the packed parts of the values are added to.
+        """
+        for value in values:
+            self.pack(value, parts)
+
+    def unpack_all(self, data: bytes, offset: int, size: int) -> tuple[list, int]:
+        """
+        Unpacks a list of values of the field, see List.
+        :param data: The packed data.
+        :param offset: Offset of the first value in the data.
+        :param size: Number of values.
+        :return: The values and the offset after the last one.
+        """
+        values = []
+        for _ in range(size):
+            value, offset = self.unpack(data, offset)
+            values.append(value)
+        return values, offset
+
+    def dumps(self, value) -> bytes:
+        """
+        Packs a message.
+        :param value: The message.
+        :return: The packed message.
+        """
+        parts = []
+        self.pack(value, parts)
+        return b''.join(parts)
+
+    def loads(self, data: bytes | memoryview):
+        """
+        Unpacks a message.
+        :param data: The packed message.
+        :return: The message.
+        :raises ValueError: If the data is not a message of the schema.
+        """
+        # Slicing bytes is faster than slicing a memoryview, a view of a
+        # buffer is copied once for the whole message.
+        data = bytes(data)
+        try:
+            value, offset = self.unpack(data, 0)
+        except struct.error as error:
+            raise ValueError(f'Truncated message: {error}') from None
+        if offset != len(data):
+            raise ValueError('Unexpected data after the message.')
+        return value
+
+
+class Bytes(Field):
+    """Bytes prefixed with their length."""
+
+    def __init__(self, length_format: str = 'I'):
+        self.length = struct.Struct('>' + length_format)
+
+    def pack(self, value: bytes, parts: list):
+        parts.append(self.length.pack(len(value)))
+        parts.append(value)
+
+    def unpack(self, data: bytes, offset: int) -> tuple[bytes, int]:
+        size, = self.length.unpack_from(data, offset)
+        offset += self.length.size
+        if offset + size > len(data):
+            raise ValueError('Truncated message.')
+        return data[offset:offset + size], offset + size
+
+
+class Text(Bytes):
+    """UTF-8 text prefixed with its length in bytes."""
+
+    def pack(self, value: str, parts: list):
+        value = value.encode(encoding)
+        parts.append(self.length.pack(len(value)))
+        parts.append(value)
+
+    def unpack(self, data: bytes, offset: int) -> tuple[str, int]:
+        size, = self.length.unpack_from(data, offset)
+        offset += self.length.size
+        if offset + size > len(data):
+            raise ValueError('Truncated message.')
+        return data[offset:offset + size].decode(encoding), offset + size
+
+
+class Id(Field):
+    """Id of a user, a uuid string packed as its 16 bytes."""
+
+    def pack(self, value: str, parts: list):
+        parts.append(pack_id(value))
+
+    def unpack(self, data: bytes, offset: int) -> tuple[str, int]:
+        if offset + 16 > len(data):
+            raise ValueError('Truncated message.')
+        return unpack_id(data[offset:offset + 16]), offset + 16
+
+
+class Integer(Field):
+    """An unsigned integer of the given struct format."""
+
+    def __init__(self, integer_format: str = 'Q'):
+        self.integer = struct.Struct('>' + integer_format)
+
+    def pack(self, value: int, parts: list):
+        parts.append(self.integer.pack(value))
+
+    def unpack(self, data: bytes, offset: int) -> tuple[int, int]:
+        return self.integer.unpack_from(data, offset)[0], offset + self.integer.size
+
+
+class Bool(Field):
+    """A boolean packed as a byte."""
+
+    def pack(self, value: bool, parts: list):
+        parts.append(b'\x01' if value else b'\x00')
+
+    def unpack(self, data: bytes, offset: int) -> tuple[bool, int]:
+        if offset >= len(data):
+            raise ValueError('Truncated message.')
+        return data[offset] != 0, offset + 1
+
+
+class List(Field):
+    """A list of values of a field prefixed with its length."""
+
+    length = struct.Struct('>I')
+
+    def __init__(self, item: Field):
+        self.item = item
+
+    def pack(self, value: list, parts: list):
+        parts.append(self.length.pack(len(value)))
+        self.item.pack_all(value, parts)
+
+    def unpack(self, data: bytes, offset: int) -> tuple[list, int]:
+        size, = self.length.unpack_from(data, offset)
+        return self.item.unpack_all(data, offset + self.length.size, size)
+
+
+class Record(Field):
+    """A tuple of values of the given fields."""
+
+    def __init__(self, *fields: Field):
+        self.fields = fields
+
+    def pack(self, value: tuple, parts: list):
+        if len(value) != len(self.fields):
+            raise ValueError(f'Expected {len(self.fields)} values, got {len(value)}.')
+        for field, item in zip(self.fields, value):
+            field.pack(item, parts)
+
+    def unpack(self, data: bytes, offset: int) -> tuple[tuple, int]:
+        value = []
+        for field in self.fields:
+            item, offset = field.unpack(data, offset)
+            value.append(item)
+        return tuple(value), offset
+
+
+class User(Record):
+    """
+    Username and id of a user, packed as a Record(Text('H'), Id()).
+    """
+
+    length = struct.Struct('>H')
+
+    def __init__(self):
+        super().__init__(Text('H'), Id())
+
+    def pack(self, value: tuple, parts: list):
+        self.pack_all([value], parts)
+
+    def unpack(self, data: bytes, offset: int) -> tuple[tuple, int]:
+        values, offset = self.unpack_all(data, offset, 1)
+        return values[0], offset
+
+    def pack_all(self, values: list, parts: list):
+        for username, _id in values:
+            username = username.encode(encoding)
+            parts += self.length.pack(len(username)), username, pack_id(_id)
+
+    def unpack_all(self, data: bytes, offset: int, size: int) -> tuple[list, int]:
+        values = []
+        unpack_length = self.length.unpack_from
+        for _ in range(size):
+            length, = unpack_length(data, offset)
+            offset += 2 + length
+            if offset + 16 > len(data):
+                raise ValueError('Truncated message.')
+            values.append((data[offset - length:offset].decode(encoding),
+                           unpack_id(data[offset:offset + 16])))
+            offset += 16
+        return values, offset
+
+
+class Message(Record):
+    """
+    A message in a chat, packed as a Record(Bytes(), Id(), Text('B'),
+    Integer('I')). The fixed-width parts after the ciphertext are packed
+    with a single struct, and the number of a message in a list is
+    unpacked with the length of the next one.
+    """
+
+    length = struct.Struct('>I')
+    # Id of the sender and the length of the time.
+    sender = struct.Struct('>16sB')
+    number = struct.Struct('>I')
+    # The number of a message and the length of the next one in a list.
+    next = struct.Struct('>II')
+
+    def __init__(self):
+        super().__init__(Bytes(), Id(), Text('B'), Integer('I'))
+
+    def pack(self, value: tuple, parts: list):
+        self.pack_all([value], parts)
+
+    def unpack(self, data: bytes, offset: int) -> tuple[tuple, int]:
+        values, offset = self.unpack_all(data, offset, 1)
+        return values[0], offset
+
+    def pack_all(self, values: list, parts: list):
+        pack_length, pack_sender, pack_number = \
+            self.length.pack, self.sender.pack, self.number.pack
+        # The messages of a chat are sent by its two users.
+        ids = {}
+        for value in values:
+            if len(value) != 4:
+                raise ValueError(f'Expected 4 values, got {len(value)}.')
+            ciphertext, sender, date_time, number = value
+            _id = ids.get(sender)
+            if _id is None:
+                _id = ids[sender] = pack_id(sender)
+            date_time = date_time.encode(encoding)
+            parts += (pack_length(len(ciphertext)), ciphertext,
+                      pack_sender(_id, len(date_time)), date_time, pack_number(number))
+
+    def unpack_all(self, data: bytes, offset: int, size: int) -> tuple[list, int]:
+        if not size:
+            return [], offset
+        unpack_length, unpack_sender, unpack_number, unpack_next = (
+            self.length.unpack_from, self.sender.unpack_from, self.number.unpack_from,
+            self.next.unpack_from)
+        ids = {}
+        values = []
+        append = values.append
+        length, = unpack_length(data, offset)
+        offset += 4
+        # A message ends with fixed-width parts, so unpacking them fails
+        # if the message is truncated.
+        for i in range(1, size + 1):
+            begin, end = offset, offset + length
+            sender, length = unpack_sender(data, end)
+            _id = ids.get(sender)
+            if _id is None:
+                _id = ids[sender] = unpack_id(sender)
+            offset = end + 17 + length
+            date_time = data[end + 17:offset].decode(encoding)
+            # The number of a message and the length of the next one are
+            # unpacked together.
+            if i < size:
+                number, length = unpack_next(data, offset)
+                offset += 8
+            else:
+                number, = unpack_number(data, offset)
+                offset += 4
+            append((data[begin:end], _id, date_time, number))
+        return values, offset
+
+
+# Username and id of a user, sent to a client when it connects and in
+# the search results.
+USER = User()
+USERS = List(USER)
+# A message in a chat, the ciphertext, id of the sender, the time it
+# was sent and its number in the chat. The messages of a chat are
+# numbered from 1 in the order they were sent.
+MESSAGE = Message()
+# Username, public key and id of the other user in a chat.
+USER_DETAILS = Record(Text('H'), Text(), Id())
+# A chat, the other user's details, id of the user that started the
+# chat, the unread status and the existing messages.
+CHAT = Record(USER_DETAILS, Id(), Bool(), List(MESSAGE))
+# The id of the other user and the number of the last message a client
+# has of each of its chats, sent when it connects so it only gets the
+# messages it missed.
+SYNC = List(Record(Id(), Integer('I')))
+# The number of the last message a client has of a chat, sent when it
+# has missed some so the server sends the messages after it again.
+LAST_SEEN = Integer('I')
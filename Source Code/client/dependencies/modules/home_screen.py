@@ -10,11 +10,12 @@ import uuid
 import socket
 import multiprocessing
 import threading
-import pickle
 import main  # noqa
-from dependencies.modules.communicator import send, receive  # noqa
-from dependencies.modules.exceptionalthread import ThreadWithExc  # noqa
+from dependencies.modules.communicator import send, receive, receive_view, tag, untag, CHAT, MESSAGE, READ  # noqa
+from dependencies.modules.cancellation import CancellableThread, CancellationToken  # noqa
 from dependencies.modules import pq_ntru  # noqa
+from dependencies.modules import codec  # noqa
+from dependencies.modules.message_store import MessageStore, load_stores  # noqa
 from kivy.clock import mainthread, Clock
 from kivy.animation import Animation
 from kivy.core.window import Window
@@ -40,6 +41,11 @@ sizes = \
         (21, 23): 230,
         (23, 25): 250,
     }
+# Number of the latest saved messages shown when a chat is loaded.
+displayed_messages = 100
+# Time in seconds after which a chat is asked for again if the server
+# has not sent it.
+chat_request_timeout = 5
 
 
 class HomeScreen(Screen):
@@ -48,47 +54,68 @@ class HomeScreen(Screen):
     SERVER: socket.socket = None
     ADDR: tuple = None
     SERVER_: socket.socket = None
+    # All the chats are multiplexed over SERVER_, the lock keeps the
+    # messages sent from different threads from interleaving.
+    SERVER_lock: threading.Lock = threading.Lock()
     chat_screens: list = []
-    listen_new_chats_thread: ThreadWithExc = None
+    listen_new_chats_thread: CancellableThread = None
     username: str = StringProperty('')
     _id: str = ''
     dialog: MDDialog = None
+    # The saved chats that have not been added yet, by the id of the
+    # other user.
+    message_stores: dict[str, MessageStore] = {}
+    # The time the chats were asked for again, by the id of the other
+    # user, see request_chat.
+    chat_requests: dict[str, float] = {}
 
     def __delete__(self):
         # Close all the connections and threads.
         if self.SERVER:
-            send('3', self.SERVER)
+            try:
+                send('3', self.SERVER)
+            except OSError:
+                # The server has already disconnected.
+                pass
             self.SERVER.close()
+        # Stopping the thread shuts down the chat connection it is
+        # listening to, so it is closed after the thread has stopped.
+        if self.listen_new_chats_thread:
+            self.listen_new_chats_thread.stop()
         if self.SERVER_:
             self.SERVER_.close()
 
         for chat in self.chat_screens:
             if chat.add_existing_chat_thread:
-                chat.add_existing_chat_thread.raiseExc(SystemExit)
-            chat.listen_messages_thread.raiseExc(SystemExit)
-            chat.chat_server.close()
-            chat.save_chat()
-        try:
-            self.listen_new_chats_thread.raiseExc(SystemExit)
-        except (ValueError, AttributeError):
-            pass
+                chat.add_existing_chat_thread.stop()
+            chat.store.close()
+        for store in self.message_stores.values():
+            store.close()
 
     def on_enter(self, *args):
         """Executed before the screen is entered."""
         if not self.SERVER_:
-            # Create a new connection with the server to listen for new
-            # chats.
+            # Create a new connection with the server for the chats.
             self.SERVER_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.SERVER_.connect((self.ADDR[0], 9090))
             # Set the keep alive options for the socket
             self.SERVER_.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             self.SERVER_.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
             self.SERVER_.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            # Every message is sent with a single send, so it is not held
+            # back to be sent with the next one.
+            self.SERVER_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
             # Receive the client username and id from the server.
-            self.username, self._id = pickle.loads(receive(self.SERVER, False))
-
-            self.listen_new_chats_thread = ThreadWithExc(target=self.listen_new_chats)
+            self.username, self._id = codec.USER.loads(receive_view(self.SERVER))
+            # Tell the server which messages of the chats are saved, so
+            # only the missed messages are sent.
+            self.message_stores = load_stores(main.data_folder_path)
+            send(codec.SYNC.dumps([(other_user_id, store.last_seen) for other_user_id, store
+                                   in self.message_stores.items()]), self.SERVER, False)
+
+            self.listen_new_chats_thread = CancellableThread(target=self.listen_new_chats)
+            self.listen_new_chats_thread.token.register(self.SERVER_)
             self.listen_new_chats_thread.start()
         else:
             self.username = receive(self.SERVER)
@@ -154,41 +181,86 @@ class HomeScreen(Screen):
         else:
             self.ids.chat_sm.current = 'Display'
 
+    def send_chat(self, kind: bytes, chat_id: str, message: bytes = b''):
+        """
+        Function to send a message to a chat on the server.
+        :param kind: Kind of the message, CHAT, MESSAGE or READ.
+        :param chat_id: Id of the chat, the other user's id.
+        :param message: The message.
+        """
+        with self.SERVER_lock:
+            send(tag(kind, chat_id, message), self.SERVER_, False)
+
+    def request_chat(self, chat_id: str, last_seen: int):
+        """
+        Function to ask the server for a chat again when messages of it
+        have been missed, the server drops the messages on a connection
+        that is too slow.
+        :param chat_id: Id of the chat, the other user's id.
+        :param last_seen: Number of the last message saved in order.
+        """
+        if time.monotonic() - self.chat_requests.get(chat_id, -chat_request_timeout) \
+                < chat_request_timeout:
+            return
+        self.chat_requests[chat_id] = time.monotonic()
+        try:
+            self.send_chat(CHAT, chat_id, codec.LAST_SEEN.dumps(last_seen))
+        except OSError:
+            # The connection is closed, the chats are sent when the app
+            # reconnects.
+            pass
+
     def listen_new_chats(self):
-        """Function to listen for new chats."""
+        """
+        Function to listen for new chats and the messages of all the
+        chats, which are tagged with the chat they belong to.
+        """
         try:
             while True:
-                # Wait for the server to send a port to connect to a new
-                # chat.
-                port = int(receive(self.SERVER_))
-
-                if port:
-                    # Connect to the chat server.
-                    chat_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    chat_server.connect((self.ADDR[0], port))
-                    # Set the keep alive options for the socket
-                    chat_server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                    chat_server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
-                    chat_server.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                # The messages are unpacked straight from the receive
+                # buffer, as the existing chats can be large.
+                kind, chat_id, message = untag(receive_view(self.SERVER_))
 
+                if kind == CHAT:
                     # Add the chat to the GUI
-                    self.add_chat(chat_server)
-        except (SystemExit, ConnectionAbortedError):
+                    self.add_chat(codec.CHAT.loads(message))
+                elif kind == MESSAGE:
+                    self.receive_chat_message(chat_id, codec.MESSAGE.loads(message))
+        except OSError:
+            # The connection is shut down when the thread is stopped.
             pass
 
     @mainthread
-    def add_chat(self, chat_server: socket.socket):
+    def receive_chat_message(self, chat_id: str, message: tuple):
+        """Function to pass a received message on to its chat."""
+        for chat in self.chat_screens:
+            if chat.name == chat_id:
+                chat.receive_message(message)
+                break
+        else:
+            # The chat was missed.
+            store = self.message_stores.get(chat_id)
+            self.request_chat(chat_id, store.last_seen if store else 0)
+
+    @mainthread
+    def add_chat(self, details: tuple):
         """Function to add a chat to the GUI."""
-        other_user = pickle.loads(receive(chat_server, False))
+        other_user, chat_started_user, unread, existing_chat = details
+        self.chat_requests.pop(other_user[2], None)
+
+        # A chat that was asked for again only has its missed messages
+        # added.
+        for chat in self.chat_screens:
+            if chat.name == other_user[2]:
+                for message in existing_chat:
+                    chat.receive_message(message, True)
+                return
 
-        chat_started_user = receive(chat_server)
         if chat_started_user == other_user[2]:
             chat_started_user = other_user[0]
         else:
             chat_started_user = 'You'
 
-        unread = pickle.loads(receive(chat_server, False))
-
         user_public_key = os.path.join(main.data_folder_path, f'{other_user[2]}')
 
         # Save the other user's public key.
@@ -205,27 +277,28 @@ class HomeScreen(Screen):
         # Create the chat screen.
         chat = self.ChatScreen(name=other_user[2])
         chat.user_chat_button = user_chat_button
-        chat.other_public_key = user_public_key
+        chat.other_public_key = pq_ntru.load_public_key(user_public_key)
         chat.ids.username_label.text = other_user[0]
         chat.ids.chat_started_label.text = f'{chat_started_user} started the chat.'
         chat.self_id = self._id
         chat.other_user_id = other_user[2]
-
-        # Check if the chat already exists.
-        message = receive(chat_server)
-        if message == '1':
+        chat.home_screen = self
+        chat.store = self.message_stores.pop(other_user[2], None)
+        if not chat.store:
+            chat.store = MessageStore(os.path.join(main.data_folder_path, other_user[2]))
+            chat.store.load()
+
+        # Check if the chat already exists, the server only sends the
+        # messages that are not saved.
+        if existing_chat or chat.store.messages:
             # Add the existing chat to the GUI.
-            existing_chat = pickle.loads(receive(chat_server, False))
             chat.ids.message_input.hint_text = 'Loading chat...'
             chat.ids.message_input.disabled = True
             chat.ids.chat_scroll_view.do_scroll = False
-            chat.add_existing_chat_thread = ThreadWithExc(target=chat.add_existing_chat,
-                                                          args=(existing_chat,))
+            token = CancellationToken()
+            chat.add_existing_chat_thread = CancellableThread(
+                token, target=chat.add_existing_chat, args=(existing_chat, token))
             chat.add_existing_chat_thread.start()
-        else:
-            chat.load_chat()
-
-        chat.chat_server = chat_server
 
         self.ids.chat_sm.add_widget(chat)
         self.chat_screens.append(chat)
@@ -235,18 +308,18 @@ class HomeScreen(Screen):
         def __init__(self, **kwargs):
             super().__init__(**kwargs)
             self.date: str = ''
-            self.chat_server: socket.socket | None = None
+            self.home_screen: HomeScreen | None = None
             self.user_chat_button: MDRectangleFlatButton | None = None
-            self.other_public_key: str = ''
+            # The keys are parsed once and reused for every message.
+            self.other_public_key: pq_ntru.NTRUencrypt | None = None
             self.self_public_key: str = os.path.join(main.data_folder_path, f'{uuid.getnode()}')
-            self.self_private_key: str = os.path.join(main.data_folder_path, f'{uuid.getnode()}')
-            self.listen_messages_thread: ThreadWithExc = ThreadWithExc(target=self.listen_messages)
-            self.listen_messages_thread.start()
-            self.add_existing_chat_thread: ThreadWithExc | None = None
-            # Since the messages are encrypted, the messages are
-            # stored in a dictionary with the encrypted message as the
-            # key and the decrypted message as the value.
-            self.chat: dict = {}
+            self.self_private_key: pq_ntru.NTRUdecrypt = pq_ntru.load_private_key(
+                os.path.join(main.data_folder_path, f'{uuid.getnode()}'))
+            self.add_existing_chat_thread: CancellableThread | None = None
+            # Messages received while the existing chat is being added.
+            self.pending_messages: list = []
+            # The saved messages of the chat and their decrypted text.
+            self.store: MessageStore | None = None
             self.self_id: str = ''
             self.other_user_id: str = ''
             self.message_label: MDCard | None = None
@@ -257,7 +330,7 @@ class HomeScreen(Screen):
         def on_enter(self, *args):
             """Executed when the screen is entered."""
             if self.user_chat_button.text_color == [1.0, 0.6470588235294118, 0.0, 1.0]:
-                send('__170523Read170523__', self.chat_server)
+                self.home_screen.send_chat(READ, self.other_user_id)
             self.user_chat_button.text_color = 'white'
             self.ids.message_input.focus = True
 
@@ -266,45 +339,50 @@ class HomeScreen(Screen):
             if args[1] == 13 and self.parent and self.parent.parent.parent.parent:
                 self.send_message()
 
-        def load_chat(self):
-            """Function to load saved-chat."""
-            saved_chat_path = os.path.join(main.data_folder_path, f'{self.other_user_id}.dat')
-
-            if os.path.exists(saved_chat_path):
-                with open(saved_chat_path, 'rb') as file:
-                    self.chat = pickle.load(file)
-
-        def save_chat(self):
-            """Function to save the chat."""
-            saved_chat_path = os.path.join(main.data_folder_path, f'{self.other_user_id}.dat')
-
-            with open(saved_chat_path, 'wb') as file:
-                pickle.dump(self.chat, file)
-
-        def add_existing_chat(self, chat):
+        def add_existing_chat(self, chat, token: CancellationToken):
             """
             Function to add an existing chat.
             This function is executed in a separate thread to
-            prevent the GUI from freezing.
+            prevent the GUI from freezing, it returns early if the
+            token is cancelled.
             """
-            try:
+            # The missed messages are saved before they are decrypted, the
+            # ones that are not decrypted are decrypted when shown.
+            messages = [message[0] for message in self.store.add_messages(chat)
+                        if message[1] == self.other_user_id
+                        and self.store.get_text(message[0]) is None]
+            if messages:
+                receiver, sender = multiprocessing.Pipe(False)
                 process = multiprocessing.Process(target=main.decrypt_messages,
-                                                  args=(chat, self.other_user_id))
+                                                  args=(messages, sender))
                 process.start()
-                process.join()
-
-                self.load_chat()
-                for message in chat:
-                    if message[1] == self.other_user_id:
-                        _message = self.decrypt_message(message[0])
-                    else:
-                        _message = message[0]
-                    self.add_message(_message, message[2], message[1] == self.self_id,
-                                     decrypted=True, animate=False)
-                self.post_add_existing_chat()
-                self.add_existing_chat_thread = None
-            except SystemExit:
-                pass
+                sender.close()
+                # Stopping the thread terminates the process, which
+                # closes its end of the pipe.
+                token.add_callback(process.terminate)
+                try:
+                    texts = receiver.recv()
+                except (EOFError, OSError):
+                    return
+                finally:
+                    receiver.close()
+                    process.join()
+                for message, text in zip(messages, texts):
+                    if text is not None:
+                        self.store.add_text(message, text)
+                if token.cancelled:
+                    return
+
+            for message in self.store.messages[-displayed_messages:]:
+                if token.cancelled:
+                    return
+                if message[1] == self.other_user_id:
+                    _message = self.decrypt_message(message[0])
+                else:
+                    _message = message[0]
+                self.add_message(_message, message[2], message[1] == self.self_id,
+                                 decrypted=True, animate=False)
+            self.post_add_existing_chat()
 
         @mainthread
         def post_add_existing_chat(self):
@@ -315,28 +393,57 @@ class HomeScreen(Screen):
             self.ids.message_input.focus = True
             self.ids.message_input.hint_text = 'Type a message'
             self.ids.chat_scroll_view.do_scroll = True
+            self.add_existing_chat_thread = None
+            for message in self.pending_messages:
+                self.receive_message(message)
+            self.pending_messages = []
 
-        def decrypt_message(self, message: str) -> str:
-            """Function to decrypt a message."""
-            try:
-                return self.chat[message]
-            except KeyError:
-                self.chat[message] = pq_ntru.decrypt(self.self_private_key, message)
-                return self.chat[message]
+        def decrypt_message(self, message: bytes) -> str | None:
+            """
+            Function to decrypt a message.
+            :param message: The encrypted message.
+            :return: The text, or None if the message is garbled or was
+                not encrypted for this user's key.
+            """
+            text = self.store.get_text(message)
+            if text is None:
+                try:
+                    text = pq_ntru.decrypt(self.self_private_key, message)
+                except ValueError:
+                    return None
+                self.store.add_text(message, text)
+            return text
 
-        def listen_messages(self):
-            """Function to listen for new messages."""
-            try:
-                while True:
-                    if self.chat_server and not self.add_existing_chat_thread:
-                        message = pickle.loads(receive(self.chat_server, False))
-                        if not self.parent:
-                            self.user_chat_button.text_color = 'orange'
-                        else:
-                            send('__170523Read170523__', self.chat_server)
-                        self.add_message(message[0], message[2], message[1] == self.self_id)
-            except SystemExit:
-                pass
+        @mainthread
+        def receive_message(self, message: tuple, missed: bool = False):
+            """
+            Function to add a received message to the chat.
+            :param message: The message, see codec.MESSAGE.
+            :param missed: Whether the message was sent again with the
+                chat after a gap, the messages before it may no longer
+                be on the server.
+            """
+            if self.add_existing_chat_thread:
+                # The message is added after the existing chat.
+                self.pending_messages.append(message)
+                return
+            if message[3] <= self.store.last_seen:
+                return
+            # The messages after a gap are dropped, the chat is asked
+            # for again from the last message saved in order.
+            if message[3] != self.store.last_seen + 1 and not missed:
+                self.home_screen.request_chat(self.other_user_id, self.store.last_seen)
+                return
+            self.store.add_messages([message])
+            # The server sends the user's own messages back with their
+            # number, they are already in the chat.
+            if message[1] == self.self_id:
+                return
+            if not self.parent:
+                self.user_chat_button.text_color = 'orange'
+            else:
+                self.home_screen.send_chat(READ, self.other_user_id)
+            self.add_message(message[0], message[2], message[1] == self.self_id)
 
         def send_message(self):
             """Function to send a message."""
@@ -353,14 +460,14 @@ class HomeScreen(Screen):
                     Clock.schedule_once(lambda *args: setattr(self.ids.message_input, 'text', ''))
 
                     encrypted_message = pq_ntru.encrypt(self.other_public_key, message)
-                    self.chat[encrypted_message] = message
+                    self.store.add_text(encrypted_message, message)
 
-                    send(str(encrypted_message), self.chat_server)
+                    self.home_screen.send_chat(MESSAGE, self.other_user_id, encrypted_message)
 
             threading.Thread(target=_send).start()
 
         @mainthread
-        def add_message(self, message: str, date_time: str, self_message: bool,
+        def add_message(self, message: str | bytes | None, date_time: str, self_message: bool,
                         encrypted=True, decrypted=False, animate=True):
             """Function to add a message to the chat."""
             date_time = date_time.split('::')
@@ -373,16 +480,15 @@ class HomeScreen(Screen):
             if self_message:
                 message_label = self.SelfMessageLabel()
                 if encrypted:
-                    try:
-                        message = self.chat[message]
-                    except KeyError:
-                        message = 'Unable to load message.'
-                        message_label.ids.message_label.bold = False
-                        message_label.ids.message_label.italic = True
+                    message = self.store.get_text(message)
             else:
                 message_label = self.OtherMessageLabel()
                 if not decrypted:
                     message = self.decrypt_message(message)
+            if message is None:
+                message = 'Unable to load message.'
+                message_label.ids.message_label.bold = False
+                message_label.ids.message_label.italic = True
 
             message_label.add_text(message)
             message_label.ids.time_label.text = date_time[1]
@@ -466,7 +572,7 @@ class HomeScreen(Screen):
                 server = self.parent.parent.parent.parent.parent.SERVER
                 send('1', server)
                 send(username, server)
-                users = pickle.loads(receive(server, False))
+                users = codec.USERS.loads(receive_view(server))
                 if users:
                     for username, _id in users:
                         add_user_button = self.ids.users_list.add_user_button(username, _id)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the saved messages of a chat on the
+client.
+The messages of a chat and their decrypted text are appended to a log
+as records as they arrive, the texts are kept by the digest of their
+encrypted message, so a new message is saved without rewriting
+the chat and a message is not lost if the app is closed or crashes.
+When a chat is loaded and at least half the records in its log can be
+folded into others, the log is compacted, every message is rewritten
+as a single record with its text.
+"""
+
+import os
+import zlib
+import uuid
+import struct
+import hashlib
+import pickle
+import logging
+import threading
+from dependencies.modules import codec  # noqa
+
+# Kinds of the records in the log.
+MESSAGE = b'M'  # A message in the chat.
+TEXT = b'T'  # The decrypted text of a message.
+SAVED = b'S'  # A message with its text, written when the log is compacted.
+
+# The digest of the encrypted message and its text.
+TEXT_RECORD = codec.Record(codec.Bytes(), codec.Text())
+# A message and its text, which is empty if it is not known.
+SAVED_RECORD = codec.Record(codec.MESSAGE, codec.Text())
+records = {MESSAGE: codec.MESSAGE, TEXT: TEXT_RECORD, SAVED: SAVED_RECORD}
+
+# A record is its length and kind, the record itself, and the crc32 of
+# all of them.
+record_header = struct.Struct('>Ic')
+record_checksum = struct.Struct('>I')
+# Size in bytes of the digest the texts are kept by.
+digest_size = 16
+
+
+def get_digest(message: bytes) -> bytes:
+    """
+    Gets the digest of an encrypted message, which is several kilobytes.
+    :param message: The encrypted message.
+    :return: The digest.
+    """
+    return hashlib.blake2b(message, digest_size=digest_size).digest()
+
+
+def is_chat_id(name: str) -> bool:
+    """
+    Checks whether a name is the id of a chat, the id (a uuid4 string)
+    of the other user in the chat.
+    :param name: The name.
+    """
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+def load_stores(path: str) -> dict[str, 'MessageStore']:
+    """
+    Loads the saved chats, the other files in the folder are ignored.
+    :param path: Folder the chats are saved in.
+    :return: The saved chats by the id of the other user.
+    """
+    stores = {}
+    for file_name in os.listdir(path):
+        other_user_id, extension = os.path.splitext(file_name)
+        if extension in ('.log', '.dat') and is_chat_id(other_user_id) \
+                and other_user_id not in stores:
+            stores[other_user_id] = MessageStore(os.path.join(path, other_user_id))
+            stores[other_user_id].load()
+    return stores
+
+
+class MessageStore:
+    """Main class for the saved messages of a chat."""
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the chat without its extension, the log is
+            kept in the .log file.
+        """
+        self.path = f'{path}.log'
+        # Chats saved by the older versions are pickled in the .dat
+        # file, they are moved to the log when they are loaded.
+        self.legacy_path = f'{path}.dat'
+        # The messages of the chat in order, see codec.MESSAGE.
+        self.messages: list[tuple] = []
+        # Since the messages are encrypted, their text is kept with the
+        # digest of the encrypted message as the key, see get_text.
+        self.decrypted: dict[bytes, str] = {}
+        self.records = 0
+        # Whether the log has texts kept by their encrypted message, it
+        # is compacted when it is loaded so they are kept by digest.
+        self.outdated = False
+        self.file = None
+        # The messages are added from the GUI and the threads of the
+        # chat, the lock keeps their records from being interleaved.
+        self.lock = threading.Lock()
+
+    @property
+    def last_seen(self) -> int:
+        """Number of the last saved message, 0 if there is none."""
+        return self.messages[-1][3] if self.messages else 0
+
+    def load(self):
+        """
+        Loads the chat from its log, and opens the log to add to it.
+        """
+        if os.path.exists(self.path):
+            self.replay()
+        elif os.path.exists(self.legacy_path):
+            with open(self.legacy_path, 'rb') as file:
+                saved_chat = pickle.load(file)
+            # The chats saved before the messages were kept only have
+            # the decrypted messages.
+            if 'messages' in saved_chat:
+                self.messages, saved_chat = saved_chat['messages'], saved_chat['decrypted']
+            # The first versions kept the texts by the encrypted message
+            # as a string, the server sends it as bytes now so they can
+            # never be looked up, the messages are decrypted again.
+            self.decrypted = {get_digest(message): text for message, text in saved_chat.items()
+                              if isinstance(message, bytes)}
+            self.compact()
+            os.remove(self.legacy_path)
+
+        digests = {get_digest(message[0]) for message in self.messages}
+        if self.outdated or self.records and self.records >= 2 * (len(self.messages) + sum(
+                digest not in digests for digest in self.decrypted)):
+            self.compact()
+        self.file = open(self.path, 'ab')
+
+    def replay(self):
+        """
+        Applies the records in the log, a record that was being written
+        when the app stopped is removed from it.
+        """
+        with open(self.path, 'rb') as file:
+            data = memoryview(file.read())
+        offset = 0
+        while offset < len(data):
+            try:
+                if offset + record_header.size > len(data):
+                    raise ValueError('Truncated record header.')
+                length, kind = record_header.unpack_from(data, offset)
+                end = offset + record_header.size + length
+                if end + record_checksum.size > len(data):
+                    raise ValueError('Truncated record.')
+                if zlib.crc32(data[offset:end]) != record_checksum.unpack_from(data, end)[0]:
+                    raise ValueError('Corrupted record.')
+                self.apply(kind, records[kind].loads(data[offset + record_header.size:end]))
+            except (ValueError, KeyError) as error:
+                logging.warning(f'replay: {self.path} at {offset}: {error}')
+                os.truncate(self.path, offset)
+                return
+            self.records += 1
+            offset = end + record_checksum.size
+
+    def apply(self, kind: bytes, record: tuple):
+        """
+        Applies a record to the chat.
+        :param kind: Kind of the record.
+        :param record: The record.
+        """
+        if kind == TEXT:
+            digest = record[0]
+            # The logs written before the texts were kept by digest
+            # have the encrypted message.
+            if len(digest) != digest_size:
+                digest = get_digest(digest)
+                self.outdated = True
+            self.decrypted[digest] = record[1]
+            return
+        if kind == SAVED:
+            record, text = record
+            if text:
+                self.decrypted[get_digest(record[0])] = text
+        if record[3] > self.last_seen:
+            self.messages.append(record)
+
+    @staticmethod
+    def pack(kind: bytes, record: tuple) -> bytes:
+        """
+        Packs a record for the log.
+        :param kind: Kind of the record.
+        :param record: The record.
+        :return: The packed record.
+        """
+        data = records[kind].dumps(record)
+        data = record_header.pack(len(data), kind) + data
+        return data + record_checksum.pack(zlib.crc32(data))
+
+    def write(self, data: bytes):
+        """
+        Appends records to the log, they are flushed so they are not
+        lost if the app crashes.
+        :param data: The packed records.
+        """
+        # A thread of the chat can still be running when the app is
+        # closed, what it adds after that is not saved.
+        if self.file:
+            self.file.write(data)
+            self.file.flush()
+
+    def add_messages(self, messages: list) -> list:
+        """
+        Adds the messages that are newer than the saved ones.
+        :param messages: The messages received from the server, every
+            message has its number in the chat, see codec.MESSAGE.
+        :return: The messages that were added.
+        """
+        with self.lock:
+            new_messages = []
+            for message in messages:
+                if message[3] > self.last_seen:
+                    self.messages.append(message)
+                    new_messages.append(message)
+            if new_messages:
+                self.write(b''.join(self.pack(MESSAGE, message) for message in new_messages))
+                self.records += len(new_messages)
+            return new_messages
+
+    def get_text(self, message: bytes) -> str | None:
+        """
+        Gets the decrypted text of a message.
+        :param message: The encrypted message.
+        :return: The text, or None if it is not known.
+        """
+        return self.decrypted.get(get_digest(message))
+
+    def add_text(self, message: bytes, text: str):
+        """
+        Adds the decrypted text of a message.
+        :param message: The encrypted message.
+        :param text: The text.
+        """
+        digest = get_digest(message)
+        with self.lock:
+            self.decrypted[digest] = text
+            self.write(self.pack(TEXT, (digest, text)))
+            self.records += 1
+
+    def compact(self):
+        """
+        Replaces the log with one that has a single record for every
+        message with its text, and the texts of the messages the server
+        has not sent back yet.
+        """
+        digests = set()
+        parts = []
+        for message in self.messages:
+            digest = get_digest(message[0])
+            digests.add(digest)
+            parts.append(self.pack(SAVED, (message, self.decrypted.get(digest, ''))))
+        for digest, text in self.decrypted.items():
+            if digest not in digests:
+                parts.append(self.pack(TEXT, (digest, text)))
+        # The log is replaced atomically, so the chat is not lost if the
+        # app stops while it is written.
+        with open(f'{self.path}.tmp', 'wb') as file:
+            file.write(b''.join(parts))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'{self.path}.tmp', self.path)
+        self.records = len(parts)
+
+    def close(self):
+        """Closes the log."""
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -2,7 +2,6 @@ import numpy
 import numpy as np
 from math import log, gcd
 import sys
-from sympy import Poly, symbols
 from pq_ntru.NTRUutil import *
 import random
 
@@ -156,18 +155,19 @@ class NTRUdecrypt:
         else:
             return False
 
-    def genfg(self):
+    def genfg(self, rng=None):
         """
         Randomly generate f and g for the private key and their inverses
+        :param rng: np.random.Generator to draw f and g from, None for the global numpy state
         """
         # Make 100 attempts and exit with error if we can't find an inverse in there
         maxTries = 100
         # We don't need g to be invertible, so just randomly gen
-        self.g = genRand10(self.N, self.dg, self.dg)
+        self.g = genRand10(self.N, self.dg, self.dg, rng)
         # print(self.g)
         # Now try and generate an f with inverses mod p and mod q
         for i in range(maxTries):
-            self.f = genRand10(self.N, self.df, self.df - 1)
+            self.f = genRand10(self.N, self.df, self.df - 1, rng)
             # print(self.f)
             invStat = self.invf()
             if invStat:
@@ -179,9 +179,7 @@ class NTRUdecrypt:
         """
         Generate the public key from the class values (that must have been generated previously)
         """
-        x = symbols('x')
-        self.h = Poly((Poly(self.p * self.fq, x).trunc(self.q) * Poly(self.g, x)).trunc(self.q) \
-                      % Poly(self.I, x)).all_coeffs()
+        self.h = centre_mod(ring_mul(centre_mod(self.p * self.fq, self.q), self.g, self.N), self.q)
         # print(self.h)
 
     def writePub(self, filename="key"):
@@ -247,37 +245,53 @@ class NTRUdecrypt:
 
     def decrypt(self, e):
         """
-        Decrypt the message given as in an input array e into the decrypted message m and return.
+        Decrypt the message given as in an input array e into the decrypted message m and return
+        it as an array of length N (including any leading zeros).
         """
         # The encrypted message e must have degree < N
         if len(e) > self.N:
             sys.exit("Encrypted message has degree > N")
         # Error checks passed, now decrypt and return as a np array
-        x = symbols('x')
-        a = ((Poly(self.f, x) * Poly(e, x)) % Poly(self.I, x)).trunc(self.q)
-        b = a.trunc(self.p)
-        c = ((Poly(self.fp, x) * b) % Poly(self.I, x)).trunc(self.p)
+        a = centre_mod(ring_mul(self.f, e, self.N), self.q)
+        b = centre_mod(a, self.p)
+        c = centre_mod(ring_mul(self.fp, b, self.N), self.p)
 
-        return np.array(c.all_coeffs(), dtype=int)
+        return c
+
+    def decryptBlocks(self, Me):
+        """
+        Decrypt all the encrypted blocks in the array Me (of length a multiple of N) at once.
+        The blocks are the rows of a (blocks, N) matrix, so every step of decrypt is done for
+        all the blocks together, and the decrypted blocks are returned as a single flat array.
+        """
+        Me = np.asarray(Me, dtype=np.int64).reshape(-1, self.N)
+        a = centre_mod(ring_mul(Me, self.f, self.N), self.q)
+        b = centre_mod(a, self.p)
+        c = centre_mod(ring_mul(b, self.fp, self.N), self.p)
+
+        return c.ravel()
 
     def decryptString(self, E):
         """
         Decrypt a message encoded using the requisite public key from an encoded to a decoded string.
+        E is either a binary ciphertext (bytes) or a ciphertext in the legacy text format (str).
+        The decrypted string is saved to self.M and returned, a ValueError is raised if the
+        ciphertext is garbled or the string cannot be decoded (e.g. with the wrong key).
         """
 
-        # First convert the string to a numpy
-        Me = np.fromstring(E, dtype=int, sep=' ')
+        # First convert the ciphertext (binary, or legacy text) to a numpy array
+        Me, version = cipher2arr(E, self.N, self.q)
         # And check the input array is the correct length, i.e. an integer multiple of N
         if np.mod(len(Me), self.N) != 0:
-            sys.exit("\n\nERROR : Input decrypt string is not integer multiple of N\n\n")
+            raise ValueError("Input decrypt string is not integer multiple of N")
 
-        # Now decrypt each block, appending to the message string
-        Marr = np.array([], dtype=int)
-        for D in range(len(Me) // self.N):
-            Marr = np.concatenate((Marr, padArr(self.decrypt(Me[D * self.N:(D + 1) * self.N]), self.N)))
+        # Now decrypt all the blocks together
+        Marr = self.decryptBlocks(Me)
 
-        # And return the string decrypted
-        self.M = bit2str(Marr)
+        # And return the string decrypted, older ciphertexts use the legacy bit framing
+        M = bit2str(Marr) if version >= 2 else bit2str_legacy(Marr)
+        self.M = M
+        return M
 
     def generate_large_prime(self, num_bits):
         while True:
@@ -316,7 +330,11 @@ class NTRUdecrypt:
         y = x1
         return gcd, x, y
 
-    def generate_keys_with_rsa(self, filename="key"):
+    def generate_keys_with_rsa(self, filename="key", new_fg=True):
+        """
+        Generate RSA keys and (unless new_fg is False, to keep the ones already generated)
+        f, g and h, then write the public and private key files.
+        """
         size = 100
         e = 65537
         while True:
@@ -328,8 +346,9 @@ class NTRUdecrypt:
         phi_n = (p - 1) * (q - 1)
         _, d, __ = self.extended_euclidean_algorithm(e, phi_n)
 
-        self.genfg()
-        self.genh()
+        if new_fg:
+            self.genfg()
+            self.genh()
 
         #### Saving public key
         pubHead = "p ::: " + str(self.p) + "\nq ::: " + str(self.q) + "\nN ::: " + str(self.N) \
@@ -345,19 +364,17 @@ class NTRUdecrypt:
         # return (e, n), (d, n)
 
     def decrypt_with_rsa(self, E):
-        # First convert the string to a numpy
-        Me = np.fromstring(E, dtype=int, sep=' ')
+        # First convert the ciphertext (binary, or legacy text) to a numpy array
+        Me, version = cipher2arr(E, self.N, self.q)
         # And check the input array is the correct length, i.e. an integer multiple of N
         if np.mod(len(Me), self.N) != 0:
-            sys.exit("\n\nERROR : Input decrypt string is not integer multiple of N\n\n")
+            raise ValueError("Input decrypt string is not integer multiple of N")
 
-        # Now decrypt each block, appending to the message string
-        Marr = np.array([], dtype=int)
-        for D in range(len(Me) // self.N):
-            Marr = np.concatenate((Marr, padArr(self.decrypt(Me[D * self.N:(D + 1) * self.N]), self.N)))
+        # Now decrypt all the blocks together
+        Marr = self.decryptBlocks(Me)
 
         # And return the string decrypted
-        self.M = bit2str(Marr)
+        self.M = bit2str(Marr) if version >= 2 else bit2str_legacy(Marr)
 
         decrypted_m = pow(int(self.M), self.d_rsa, self.n_rsa)
         # print(decrypted_m)
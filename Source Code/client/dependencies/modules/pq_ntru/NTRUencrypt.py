@@ -1,6 +1,5 @@
 import numpy as np
 import sys
-from sympy import Poly, symbols
 from pq_ntru.NTRUutil import *
 
 
@@ -34,7 +33,7 @@ class NTRUencrypt:
         self.readKey = False  # We have not yet read the public key file
 
         # Variables to save any possible encrypted messages (if req)
-        self.Me = None  # The encrypted message as a string
+        self.Me = None  # The encrypted message in the binary ciphertext format
 
         self.n_rsa = None
         self.e_rsa = None
@@ -74,9 +73,8 @@ class NTRUencrypt:
             sys.exit("ERROR : Public key not read before setting message")
         if len(M) > self.N:
             sys.exit("ERROR : Message length longer than degree of polynomial ring ideal")
-        for i in range(len(M)):
-            if M[i] < -self.p / 2 or M[i] > self.p / 2:
-                sys.exit("ERROR : Elements of message must be in [-p/2,p/2]")
+        if np.any((np.asarray(M) < -self.p / 2) | (np.asarray(M) > self.p / 2)):
+            sys.exit("ERROR : Elements of message must be in [-p/2,p/2]")
         # Passed the error checks, so now save the class message function, inc leading zeros
         self.m = padArr(M, self.N)
 
@@ -93,31 +91,46 @@ class NTRUencrypt:
             if len(m) > self.N:
                 sys.exit("\n\nERROR: Polynomial message of degree >= N")
             self.m = m
-        x = symbols('x')
-        # Actually perform the encryption, set the class variable
-        self.e = np.array(((((Poly(self.r, x) * Poly(self.h, x)).trunc(self.q))
-                            + Poly(self.m, x)) % Poly(self.I, x)).trunc(self.q).all_coeffs(), dtype=int)
-        self.e = padArr(self.e, self.N)
+        # Actually perform the encryption, e = r*h + m in Z_q[x]/(x^N - 1), set the class variable
+        self.e = centre_mod(ring_mul(self.r, self.h, self.N) + padArr(self.m, self.N), self.q)
+
+    def encryptBlocks(self, bM):
+        """
+        Encrypt every block (of length N) of the binary message array bM at once, each block
+        with a different random obfuscating polynomial, and return the encrypted blocks as an
+        array of shape (blocks, N).
+        NOTE : The length of bM must be a multiple of N.
+        """
+        # We have to have read the public key before starting
+        if not self.readKey:
+            sys.exit("Error : Not read the public key file, so cannot encrypt")
+        bM = np.asarray(bM, dtype=np.int64).reshape(-1, self.N)
+        if np.any((bM < -self.p / 2) | (bM > self.p / 2)):
+            sys.exit("ERROR : Elements of message must be in [-p/2,p/2]")
+
+        # Generate all the random obfuscating polynomials, then e = r*h + m for every block
+        R = genRand10Rows(len(bM), self.N, self.dr, self.dr)
+        return centre_mod(ring_mul(R, self.h, self.N) + bM, self.q)
 
     def encryptString(self, M):
+        """
+        Encrypt the string M, save the encrypted message to self.Me and return it.
+        NOTE : Only local variables are used until the end, so a single instance (i.e. a
+               cached key) can encrypt strings from several threads.
+        """
         # We have to have read the public key before starting
         if not self.readKey:
             sys.exit("Error : Not read the public key file, so cannot encrypt")
 
-        # Create a binary array of the input string, and pad it with leading zeros
-        # such that its length is a multiple of N
+        # Create a binary array of the input string, and pad it with trailing zeros
+        # such that its length is a multiple of N (the length prefix marks the end)
         bM = str2bit(M)
-        bM = padArr(bM, len(bM) - np.mod(len(bM), self.N) + self.N)
+        bM = np.pad(bM, (0, np.mod(-len(bM), self.N)))
 
-        # We then need an empty string to save the encrypted message to
-        self.Me = ""
-
-        # And loop through encrypting each message block (of length N) with different random polynomial
-        for E in range(len(bM) // self.N):
-            self.genr()  # Gen random obfuscating polynomial
-            self.setM(bM[E * self.N:(E + 1) * self.N])  # Set the messsage to encrypt as single block
-            self.encrypt()  # Encrypt the saved message
-            self.Me = self.Me + arr2str(self.e) + " "  # Append encrypted to string
+        # Encrypt all the message blocks together and save them in the binary ciphertext format
+        Me = arr2bin(self.encryptBlocks(bM), self.N, self.q)
+        self.Me = Me
+        return Me
 
     def read_pub_rsa(self, filename="key.pub"):
         with open(filename, "r") as f:
@@ -142,17 +155,9 @@ class NTRUencrypt:
             sys.exit("Error : Not read the public key file, so cannot encrypt")
 
         bM = str2bit(M)
-        bM = padArr(bM, len(bM) - np.mod(len(bM), self.N) + self.N)
-
-        # We then need an empty string to save the encrypted message to
-        self.Me = ""
+        bM = np.pad(bM, (0, np.mod(-len(bM), self.N)))
 
-        # And loop through encrypting each message block (of length N) with different random polynomial
-        for E in range(len(bM) // self.N):
-            self.genr()  # Gen random obfuscating polynomial
-            self.setM(bM[E * self.N:(E + 1) * self.N])  # Set the messsage to encrypt as single block
-            self.encrypt()  # Encrypt the saved message
-            self.Me = self.Me + arr2str(self.e) + " "  # Append encrypted to string
+        self.Me = arr2bin(self.encryptBlocks(bM), self.N, self.q)
 
 
 
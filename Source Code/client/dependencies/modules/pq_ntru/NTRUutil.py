@@ -1,8 +1,7 @@
 import numpy as np
-from math import log
+from math import log, isqrt
+import struct
 import sys
-# Use sympy for polynomial operations
-from sympy import Poly, symbols, GF, invert
 
 np.set_printoptions(threshold=sys.maxsize)
 
@@ -44,9 +43,12 @@ def checkPrime(P):
     elif P == 2 or P == 3:
         # The lowest easy primes to check for
         return True
+    elif P % 2 == 0:
+        # Even numbers over 2 are never prime
+        return False
     else:
-        # Otherwise, check if P is dividable by any value over 4 and under P/2
-        for i in range(4, P // 2):
+        # Otherwise, check if P is dividable by any odd value up to sqrt(P)
+        for i in range(3, isqrt(P) + 1, 2):
             if P % i == 0:
                 # P is dividable so it is not prime
                 return False
@@ -64,48 +66,189 @@ def poly_inv(poly_in, poly_I, poly_mod):
     Inputs and outputs are given as an array of coefficients where
         x^4 + 5x^2 + 3 == [1,0,5,0,3]
 
+    For prime poly_mod the inverse is found with the extended Euclidean algorithm over
+    GF(poly_mod). For poly_mod a power of 2 the inverse is found over GF(2) and then lifted
+    to poly_mod with Newton (Hensel) iterations, each of which doubles the number of correct
+    bits. The ideal poly_I must be x^N - 1 (as everywhere in this package), as the products
+    are done with ring_mul.
+
     Returns
     =======
     Either an empty array if the inverse cannot be found, or the inverse of the
-    polynomial poly_in as an array of coefficients.
+    polynomial poly_in as an array of coefficients (in [0, poly_mod)).
 
     References
     ==========
     https://arxiv.org/abs/1311.1779
     """
-    x = symbols('x')
-    Ppoly_I = Poly(poly_I, x)
-    Npoly_I = len(Ppoly_I.all_coeffs())
+    N = len(poly_I) - 1
     if checkPrime(poly_mod):
-        # For prime poly_mod we only need use the sympy invert routine, we then pull out
-        # all the coefficients for the inverse and return (not all_coeffs() also includes
-        # zeros in the array
-        try:
-            inv = invert(Poly(poly_in, x).as_expr(), Ppoly_I.as_expr(), domain=GF(poly_mod, symmetric=False))
-        except:
-            return np.array([])
+        inv = poly_inv_prime(poly_in, poly_I, poly_mod)
     elif log(poly_mod, 2).is_integer():
-        try:
-            # Follow the procedure outlined in https://arxiv.org/abs/1311.1779 to find the inverse
-            inv = invert(Poly(poly_in, x).as_expr(), Ppoly_I.as_expr(), domain=GF(2, symmetric=False))
-            ex = int(log(poly_mod, 2))
-            for a in range(1, ex):
-                inv = ((2 * Poly(inv, x) - Poly(poly_in, x) * Poly(inv, x) ** 2) % Ppoly_I).trunc(poly_mod)
-            inv = Poly(inv, domain=GF(poly_mod, symmetric=False))
-        except:
-            return np.array([])
+        # Follow the procedure outlined in https://arxiv.org/abs/1311.1779 to find the inverse
+        inv = poly_inv_prime(poly_in, poly_I, 2)
+        two = padArr(np.array([2], dtype=np.int64), N)
+        mod = 2
+        while len(inv) > 0 and mod < poly_mod:
+            # inv = inv * (2 - poly_in * inv), correct modulo the square of the previous mod
+            mod = min(mod * mod, poly_mod)
+            inv = np.mod(ring_mul(inv, np.mod(two - ring_mul(poly_in, inv, N), mod), N), mod)
     else:
         # Otherwise we cannot find the inverse
         return np.array([])
+    if len(inv) == 0:
+        return np.array([])
 
     # If we have got this far we have calculated an inverse, double check the inverse via poly mult
-    tmpCheck = np.array(Poly((Poly(inv, x) * Poly(poly_in, x)) % Ppoly_I,
-                             domain=GF(poly_mod, symmetric=False)).all_coeffs(), dtype=int)
-    if len(tmpCheck) > 1 or tmpCheck[0] != 1:
+    tmpCheck = np.mod(ring_mul(inv, poly_in, N), poly_mod)
+    if tmpCheck[-1] != 1 or np.any(tmpCheck[:-1]):
         sys.exit("ERROR : Error in calculation of polynomial inverse")
 
     # Passed the error check so return polynomial coefficients as array
-    return padArr(np.array(Poly(inv, x).all_coeffs(), dtype=int), Npoly_I - 1)
+    return inv
+
+
+def poly_inv_prime(poly_in, poly_I, poly_mod):
+    """
+    Find the inverse of the polynomial poly_in in Z/poly_mod[X]/poly_I for a prime poly_mod,
+    with the extended Euclidean algorithm on arrays of coefficients.
+
+    Returns
+    =======
+    Either an empty array if poly_in and poly_I are not coprime over GF(poly_mod), or the
+    inverse as an array of len(poly_I) - 1 coefficients in [0, poly_mod).
+    """
+    N = len(poly_I) - 1
+    # Keep r0 = s0 * poly_in and r1 = s1 * poly_in (mod poly_I) while reducing r0, r1 to their gcd
+    r0, r1 = poly_trim(np.mod(poly_I, poly_mod)), poly_trim(np.mod(poly_in, poly_mod))
+    s0, s1 = np.zeros(0, dtype=np.int64), np.ones(1, dtype=np.int64)
+    while len(r1) > 1:
+        quot, rem = poly_divmod(r0, r1, poly_mod)
+        r0, r1 = r1, rem
+        s0, s1 = s1, poly_sub(s0, np.convolve(quot, s1), poly_mod)
+    if len(r1) == 0:
+        # The gcd is not a constant, so there is no inverse
+        return np.array([])
+    # The gcd is the constant r1, so scale s1 by its inverse
+    return padArr(np.mod(s1 * pow(int(r1[0]), -1, poly_mod), poly_mod), N)
+
+
+def poly_trim(A_in):
+    """
+    Remove the leading zeros of the integer array A_in, the zero polynomial becomes an
+    empty array.
+    """
+    nonzero = np.flatnonzero(A_in)
+    return np.asarray(A_in[nonzero[0]:] if len(nonzero) else A_in[:0], dtype=np.int64)
+
+
+def poly_sub(A_in, B_in, mod):
+    """
+    Subtract the polynomial B_in from A_in over GF(mod) (arrays of any length, highest power
+    first), and return the result without leading zeros.
+    """
+    size = max(len(A_in), len(B_in))
+    return poly_trim(np.mod(padArr(A_in, size) - padArr(B_in, size), mod))
+
+
+def poly_divmod(num, den, mod):
+    """
+    Divide the polynomial num by den over GF(mod) for a prime mod, where den has no leading
+    zeros. The quotient and remainder are returned without leading zeros.
+    """
+    rem = np.mod(np.asarray(num, dtype=np.int64), mod)
+    shift = len(rem) - len(den)
+    if shift < 0:
+        return np.zeros(0, dtype=np.int64), poly_trim(rem)
+    quot = np.zeros(shift + 1, dtype=np.int64)
+    lead_inv = pow(int(den[0]), -1, mod)
+    for i in range(shift + 1):
+        # Cancel the leading coefficient of the remainder
+        c = int(rem[i]) * lead_inv % mod
+        if c:
+            quot[i] = c
+            rem[i:i + len(den)] = np.mod(rem[i:i + len(den)] - c * den, mod)
+    return poly_trim(quot), poly_trim(rem[shift + 1:])
+
+
+def centre_mod(A_in, mod):
+    """
+    Reduce the integer array A_in modulo mod into the centred range used throughout the
+    package (as sympy's Poly.trunc did), i.e. every coefficient c is mapped to c mod mod
+    and then shifted down by mod if it is greater than mod // 2.
+
+    INPUTS:
+    =======
+    A_in : Numpy integer array (of any shape), the coefficients to reduce.
+    mod  : Integer, the modulus.
+
+    RETURNS:
+    ========
+    An int64 numpy array of the same shape as A_in with values in [-(mod-1)//2, mod//2].
+    """
+    A_out = np.mod(np.asarray(A_in, dtype=np.int64), mod)
+    A_out[A_out > mod // 2] -= mod
+    return A_out
+
+
+_ring_index_cache = {}
+_ring_matrix_min_rows = 16
+
+
+def ring_mul(A_in, B_in, N):
+    """
+    Multiply the polynomials A_in and B_in in the ring Z[x]/(x^N - 1), without any
+    coefficient reduction, so the result is exact and can be reduced afterwards with
+    centre_mod.
+
+    Both inputs are given as arrays of coefficients with the highest power first (as
+    everywhere else in this package), and may be shorter than N, in which case they are
+    padded with leading zeros. A_in may also be a 2-D array with one polynomial per row,
+    in which case every row is multiplied by B_in and a 2-D array is returned.
+
+    A single product is computed as a full linear convolution which is then folded back
+    onto the ring (x^N == 1). For a batch of rows the multiplication by B_in is written
+    as the N x N circulant matrix of B_in (see ring_matrix) so that all the rows are
+    multiplied with a single (exact) matrix product.
+
+    RETURNS:
+    ========
+    An int64 numpy array of length N (or of shape (rows, N) for a 2-D A_in).
+    """
+    B_in = padArr(np.asarray(B_in, dtype=np.int64), N)
+    A_in = np.asarray(A_in, dtype=np.int64)
+    if A_in.ndim == 2:
+        # Building the circulant matrix only pays off when there are enough rows
+        if len(A_in) < _ring_matrix_min_rows:
+            return np.array([ring_mul(A_row, B_in, N) for A_row in A_in], dtype=np.int64).reshape(-1, N)
+        B_mat = ring_matrix(B_in, N)
+        # Only floating point matrix products go through BLAS, but as long as every partial
+        # sum is an integer below 2^53 the float64 product is still exact
+        if N * int(np.abs(A_in).max(initial=0)) * int(np.abs(B_in).max(initial=0)) < 2 ** 53:
+            return np.rint(A_in.astype(np.float64) @ B_mat.astype(np.float64)).astype(np.int64)
+        return A_in @ B_mat
+
+    A_in = padArr(A_in, N)
+    # The convolution of two arrays of length N has length 2N-1, with the coefficient
+    # of x^(2N-2) first, the terms of degree >= N wrap around onto degree - N
+    C_full = np.convolve(A_in, B_in)
+    C_out = C_full[N - 1:].copy()
+    C_out[1:] += C_full[:N - 1]
+    return C_out
+
+
+def ring_matrix(B_in, N):
+    """
+    Return the N x N circulant matrix M of the polynomial B_in in Z[x]/(x^N - 1), such
+    that for a row vector A (highest power first) the product A @ M is A * B_in in the
+    ring. The gather index only depends on N and is cached between calls.
+    """
+    index = _ring_index_cache.get(N)
+    if index is None:
+        rows = np.arange(N)
+        index = np.mod(rows[None, :] - rows[:, None] - 1, N)
+        _ring_index_cache[N] = index
+    return padArr(np.asarray(B_in, dtype=np.int64), N)[index]
 
 
 def padArr(A_in, A_out_size):
@@ -116,10 +259,11 @@ def padArr(A_in, A_out_size):
     return np.pad(A_in, (A_out_size - len(A_in), 0), constant_values=0)
 
 
-def genRand10(L, P, M):
+def genRand10(L, P, M, rng=None):
     """
     Generate a numpy array of length L with P 1's, M -1's and the remaining elements 0.
-    The elements will be in a random order, with randomisation done using np.random.shuffle.
+    The elements will be in a random order, with randomisation done using the shuffle of rng,
+    or np.random.shuffle if it is None.
     This is used to generate the f, p and r arrays for NTRU encryption based on [1].
 
     INPUTS:
@@ -127,6 +271,7 @@ def genRand10(L, P, M):
     L : Integer, the length of the desired output array.
     P : Integer, the number of `positive' i.e. +1's in the array.
     M : Integer, the number of `negative' i.e. -1's in the array.
+    rng : np.random.Generator to shuffle with, None for the global numpy random state.
 
     RETURNS:
     ========
@@ -155,10 +300,32 @@ def genRand10(L, P, M):
             break
 
     # Return a randomised array
-    np.random.shuffle(R)
+    (rng or np.random).shuffle(R)
     return R
 
 
+def genRand10Rows(K, L, P, M):
+    """
+    Generate K independent arrays at once, each as described in genRand10, i.e. a numpy
+    array of shape (K, L) where every row has P 1's, M -1's and the remaining elements 0,
+    each row in its own random order.
+
+    Rather than shuffling every row in a Python loop, each row is permuted by sorting a
+    row of uniform random numbers, which gives a uniformly random permutation per row.
+    """
+
+    # Error check, the munber of 1's and -1's must be less than or equal to length
+    if P + M > L:
+        sys.exit("ERROR: Asking for P+M>L.")
+
+    R = np.zeros((K, L), dtype=np.int64)
+    R[:, :P] = 1
+    R[:, P:P + M] = -1
+
+    # Return every row randomised independently
+    return np.take_along_axis(R, np.argsort(np.random.random((K, L)), axis=1), axis=1)
+
+
 def arr2str(ar):
     """
     Convert a numpy array to a string containing only the elements of the array.
@@ -182,10 +349,96 @@ def arr2str(ar):
     return st
 
 
+# The binary ciphertext starts with a header of the magic bytes, the format version, N, q and
+# the number of encrypted blocks, followed by every coefficient (mod q) packed into the
+# smallest number of bits that can hold q-1 (11 bits for q = 2048).
+# Version 1 messages use the legacy bit framing (see bit2str_legacy), version 2 messages are
+# length prefixed (see str2bit).
+CIPHER_MAGIC = b"NT"
+CIPHER_VERSION = 2
+cipher_header = struct.Struct(">2sBHII")
+
+
+def arr2bin(ar, N, q):
+    """
+    Convert a numpy array of encrypted blocks to the binary ciphertext format.
+
+    INPUTS:
+    =======
+    ar : Numpy integer array, the encrypted blocks, of length (or shape) a multiple of N.
+    N  : Integer, order of the polynomial ring of the blocks.
+    q  : Integer, modulus of the encrypted coefficients.
+
+    RETURNS:
+    ========
+    A bytes object containing the header and the bit-packed coefficients.
+    """
+    bits = (q - 1).bit_length()
+    coeffs = np.mod(np.asarray(ar, dtype=np.int64).ravel(), q)
+    # Split every coefficient into its bits (most significant first), then pack them all
+    coeff_bits = (coeffs[:, None] >> np.arange(bits - 1, -1, -1)) & 1
+    return cipher_header.pack(CIPHER_MAGIC, CIPHER_VERSION, N, q, len(coeffs) // N) \
+        + np.packbits(coeff_bits.astype(np.uint8)).tobytes()
+
+
+def bin2arr(bi, N, q):
+    """
+    Convert a ciphertext in the binary format (see arr2bin) back to a numpy array of the
+    encrypted coefficients, reduced to [0, q).
+
+    INPUTS:
+    =======
+    bi : Bytes-like object, the binary ciphertext.
+    N  : Integer, order of the polynomial ring of the key used to decrypt.
+    q  : Integer, modulus of the key used to decrypt.
+
+    RETURNS:
+    ========
+    A tuple of the flat int64 numpy array of coefficients and the format version.
+
+    RAISES:
+    =======
+    ValueError if the ciphertext is garbled or was not encrypted for this key.
+    """
+    if len(bi) < cipher_header.size:
+        raise ValueError("Input ciphertext is too short")
+    magic, version, bi_N, bi_q, blocks = cipher_header.unpack_from(bi)
+    if magic != CIPHER_MAGIC or version > CIPHER_VERSION:
+        raise ValueError("Input ciphertext is not in a known format")
+    if bi_N != N or bi_q != q:
+        raise ValueError("Input ciphertext was not encrypted for this key's N and q")
+    bits = (q - 1).bit_length()
+    coeff_bits = np.unpackbits(np.frombuffer(bi, dtype=np.uint8, offset=cipher_header.size))
+    if len(coeff_bits) < blocks * N * bits:
+        raise ValueError("Input ciphertext is truncated")
+    coeff_bits = coeff_bits[:blocks * N * bits].reshape(-1, bits).astype(np.int64)
+    return coeff_bits @ (1 << np.arange(bits - 1, -1, -1, dtype=np.int64)), version
+
+
+def cipher2arr(E, N, q):
+    """
+    Convert a ciphertext to a numpy array of the encrypted coefficients. Ciphertexts in the
+    binary format are given as bytes, while ciphertexts in the legacy format (produced by
+    older versions, see arr2str) are strings of space separated integers.
+
+    RETURNS:
+    ========
+    A tuple of the flat int64 numpy array of coefficients and the format version, where
+    version 0 is the legacy text format.
+    """
+    if isinstance(E, (bytes, bytearray, memoryview)):
+        return bin2arr(E, N, q)
+    return np.fromstring(E, dtype=np.int64, sep=" "), 0
+
+
 def str2bit(st):
     """
     Convert the input string st into a binary representation of the string, with each
-    bit as an element of an integer numpy array.
+    bit as an element of a numpy array.
+
+    The UTF-8 bytes of the string are prefixed with their length as a 4 byte big-endian
+    integer, so any padding after the bits can be ignored and no bytes (e.g. leading zero
+    bytes) are lost.
 
     INPUTS:
     =======
@@ -193,41 +446,57 @@ def str2bit(st):
 
     RETURNS:
     ========
-    A numpy array containing only 1's and 0's representing the input string st in binary.
-    NOTE : The initial "0b" is removed from the output array.
+    A uint8 numpy array containing only 1's and 0's, 32 + 8 * (number of bytes) long.
     """
-    return np.array(list(bin(int.from_bytes(str(st).encode(), "big")))[2:], dtype=int)
+    st = str(st).encode()
+    return np.unpackbits(np.frombuffer(struct.pack(">I", len(st)) + st, dtype=np.uint8))
 
 
 def bit2str(bi):
     """
-    Convert an array of bits to the string described by those bits.
+    Convert an array of bits produced by str2bit (optionally followed by padding) to the
+    string described by those bits.
 
     INPUTS:
     =======
-    bi : Numpy integer array, containing only 1's and 0's. When flattened this represents a
-         string (not including the "0b" prefix).
+    bi : Numpy integer array, containing only 1's and 0's.
 
     RETURNS:
     ========
-    A string, the binary values in the bi array converted to a string.
+    A string, the binary values in the bi array converted to a string. Invalid UTF-8 is
+    replaced with U+FFFD rather than dropped.
+
+    RAISES:
+    =======
+    ValueError if the bits do not hold a length prefixed string, e.g. when they were
+    decrypted with the wrong key.
     """
+    by = np.packbits(np.asarray(bi) != 0).tobytes()
+    if len(by) < 4:
+        raise ValueError("Decrypted message is too short to contain its length")
+    length = struct.unpack_from(">I", by)[0]
+    if length > len(by) - 4:
+        raise ValueError("Decrypted message is shorter than its length")
+    return by[4:4 + length].decode("utf-8", errors="replace")
+
 
-    # Make sure the number of bits in the string is dividable by 8 (8 bits per character)
-    # S = padArr(bi, len(bi) + np.mod(len(bi), 8))
+def bit2str_legacy(bi):
+    """
+    Convert an array of bits in the framing used by older versions of str2bit (the bits of
+    the string as one big integer, padded with leading zeros) to the string described by
+    those bits.
 
-    # Convert the input binary array to a string and remove any spaces
-    S = arr2str(bi)
-    S = S.replace(" ", "")
+    The bits are read 8 at a time from the end and, as in the old decoder, every byte is
+    decoded on its own, so zero bytes and bytes that are not ASCII are dropped.
 
-    # Then take each 8 bit section on its own, starting from last bits (to avoid issues
-    # that can arise from padding the front of the array with 0's)
-    charOut = ""
-    for i in range(len(S) // 8):
-        if i == 0:
-            charb = S[len(S) - 8:]
-        else:
-            charb = S[-(i + 1) * 8:-i * 8]
-        charb = int(charb, 2)
-        charOut = charb.to_bytes((charb.bit_length() + 7) // 8, "big").decode("utf-8", errors="ignore") + charOut
-    return charOut
+    INPUTS:
+    =======
+    bi : Numpy integer array, containing only 1's and 0's.
+
+    RETURNS:
+    ========
+    A string, the binary values in the bi array converted to a string.
+    """
+    bi = np.asarray(bi)
+    by = np.packbits(bi[len(bi) % 8:] != 0)
+    return by[(by > 0) & (by < 128)].tobytes().decode("ascii")
@@ -4,7 +4,10 @@ from pq_ntru.NTRUencrypt import *
 from pq_ntru.NTRUutil import *
 
 from pq_ntru.ntru import generate_keys
+from pq_ntru.ntru import find_keys
 from pq_ntru.ntru import encrypt
 from pq_ntru.ntru import decrypt
+from pq_ntru.ntru import load_public_key
+from pq_ntru.ntru import load_private_key
 
 __version__ = 0.1
\ No newline at end of file
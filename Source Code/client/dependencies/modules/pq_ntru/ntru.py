@@ -1,6 +1,11 @@
 from pq_ntru.NTRUencrypt import NTRUencrypt
 from pq_ntru.NTRUdecrypt import NTRUdecrypt
 from pq_ntru.NTRUutil import factor_int
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+import os
+import random
 import time
 
 prog_description = """
@@ -19,12 +24,75 @@ References:
 """
 
 
-def generate_keys(name="key", mode="highest", skip_check=False, debug=False):
+def security_check(N1):
+    """
+    :param N1: NTRUdecrypt with the keys generated
+    :return: whether the keys pass the security check
+    """
+    factors = factor_int(N1.h[-1])
+    possible_keys = 2 ** N1.df * (N1.df + 1) ** 2 * 2 ** N1.dg * (N1.dg + 1) * 2 ** N1.dr * (N1.dr + 1)
+    return len(factors) == 0 and possible_keys > 2 ** 80  # see 'security_check.py' for more information
+
+
+def key_candidate(settings, seed, skip_check=False):
+    """
+    Generate one candidate for the keys, this is run in the worker processes of find_keys.
+    :param settings: list of keyword arguments for NTRUdecrypt.setNpq, applied in order
+    :param seed: np.random.SeedSequence of the generator used for f and g, the candidate has
+                 its own generator so the global numpy random state is not touched
+    :param skip_check: whether to skip the security check
+    :return: the NTRUdecrypt with f, g, their inverses and h, and whether it passed the check
+    """
+    N1 = NTRUdecrypt()
+    for setting in settings:
+        N1.setNpq(**setting)
+    N1.genfg(np.random.default_rng(seed))
+    N1.genh()
+
+    return N1, skip_check or security_check(N1)
+
+
+def find_keys(settings, skip_check=False, rounds=10, workers=1, seed=None):
+    """
+    Generate up to `rounds` candidates for the keys and choose the first one (in the order of
+    the rounds) that passes the security check. Every round has its own seed derived from
+    `seed`, so the chosen keys only depend on `seed` and not on the number of workers.
+    :param settings: list of keyword arguments for NTRUdecrypt.setNpq, applied in order
+    :param skip_check: whether to skip the security check
+    :param rounds: maximum number of candidates
+    :param workers: number of processes to generate the candidates in concurrently,
+                    1 generates them one at a time in this process
+    :param seed: seed for reproducible keys, None to seed from the OS
+    :return: the chosen NTRUdecrypt (the last candidate if none passed) and whether it passed
+    """
+    # The seed sequences keep the full entropy of `seed` (or of the OS if it is None), every
+    # round gets its own child of it.
+    seeds = np.random.SeedSequence(seed).spawn(rounds)
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        if pool:
+            futures = [pool.submit(key_candidate, settings, s, skip_check) for s in seeds]
+            candidates = (future.result() for future in futures)
+        else:
+            candidates = (key_candidate(settings, s, skip_check) for s in seeds)
+        for N1, passed in candidates:
+            if passed:
+                return N1, True
+            print("failed")
+        return N1, False
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_keys(name="key", mode="highest", skip_check=False, debug=False, workers=1, seed=None):
     if mode not in ["moderate", "high", "highest"]:
         raise ValueError("Input string must be 'moderate', 'high', or 'highest'")
     """
     :param name: name of file output
     :param mode: moderate, high, highest
+    :param workers: number of processes to try candidate keys in (see find_keys)
+    :param seed: seed for reproducible keys (see find_keys)
     :return:
     """
     if debug:
@@ -66,89 +134,110 @@ def generate_keys(name="key", mode="highest", skip_check=False, debug=False):
             print("[-] Couldn't generate key, as security couldn't be verified in 10 checks.")
         print("[+] Done.")
     else:
-        finished = False
-        for i in range(10):
-            N1 = NTRUdecrypt()
-            if mode == "moderate":
-                N1.setNpq(N=107, p=3, q=64, df=15, dg=12, d=5)
-            elif mode == "high":
-                N1.setNpq(N=167, p=3, q=128, df=61, dg=20, d=18)
-            elif mode == "highest":
-                N1.setNpq(N=503, p=3, q=256, df=216, dg=72, d=55)
+        if mode == "moderate":
+            settings = [dict(N=107, p=3, q=64, df=15, dg=12, d=5)]
+        elif mode == "high":
+            settings = [dict(N=167, p=3, q=128, df=61, dg=20, d=18)]
+        elif mode == "highest":
+            settings = [dict(N=503, p=3, q=256, df=216, dg=72, d=55)]
+
+        # N1.setNpq(N=503, p=3, q=2048, df=216, dg=72, d=55)
+        settings.append(dict(N=503, p=3, q=2048, df=216, dg=72, d=55))
+
+        # print("ye")
+
+        """
+        N: Primzahl. Je höher die Primzahl, desto mehr Sicherheit wird garantiert.
+        p: Ebenfalls eine Primzahl.
+        q: Bit-Größe der Verschlüsselung. Sehr wichtig um Sicherheit zu garantieren. 
+        df: Maximale Anzahl von Koeffizienten in einem Polynom. df = dual Fehler. Je größer, desto mehr Sicherheit. Normal: 100 - 500.
+        dg: Anzahl der Koeffizienten in einem Polynom `g` und `g`.
+        d: Schlüsselgrad. Bestimmt die Länge des geheimen Schlüssels.
+        
+        p und q müssen teilerfremd sein.
+        q muss größer als p sein.
+        
+        f: Ein Polynom, das in der Regel zufällig gewählt wird. Es hat Grad N und ist definiert über dem Ring R.
+        fp: Ein Polynom, der das Inverse von f modulo p ist. p ist eine große Primzahl.
+        fq: Ein Polynom, der das Inverse von f modulo q ist. q ist eine große Primzahl, die 1 modulo N ist.
+        g: Ein weiteres Polynom, das in der Regel zufällig gewählt wird. Es hat Grad N und ist definiert über dem Ring R.
+        h: Das Geheimnis, das verschlüsselt werden soll. Es ist ein Polynom mit Grad N-1 und Koeffizienten, die aus {0, 1, -1} gewählt werden.
+        I: Die Einheitsmatrix der Größe N-1.
+        """
+
+        N1, finished = find_keys(settings, skip_check, workers=workers, seed=seed)
+        N1.writePub(name)
+        N1.writePriv(name)
+        if not finished:
+            print("[-] Security of keys couldn't get verified.")
 
-            # N1.setNpq(N=503, p=3, q=2048, df=216, dg=72, d=55)
-            N1.setNpq(N=503, p=3, q=2048, df=216, dg=72, d=55)
-
-            # print("ye")
-
-            """
-            N: Primzahl. Je höher die Primzahl, desto mehr Sicherheit wird garantiert.
-            p: Ebenfalls eine Primzahl.
-            q: Bit-Größe der Verschlüsselung. Sehr wichtig um Sicherheit zu garantieren. 
-            df: Maximale Anzahl von Koeffizienten in einem Polynom. df = dual Fehler. Je größer, desto mehr Sicherheit. Normal: 100 - 500.
-            dg: Anzahl der Koeffizienten in einem Polynom `g` und `g`.
-            d: Schlüsselgrad. Bestimmt die Länge des geheimen Schlüssels.
-            
-            p und q müssen teilerfremd sein.
-            q muss größer als p sein.
-            
-            f: Ein Polynom, das in der Regel zufällig gewählt wird. Es hat Grad N und ist definiert über dem Ring R.
-            fp: Ein Polynom, der das Inverse von f modulo p ist. p ist eine große Primzahl.
-            fq: Ein Polynom, der das Inverse von f modulo q ist. q ist eine große Primzahl, die 1 modulo N ist.
-            g: Ein weiteres Polynom, das in der Regel zufällig gewählt wird. Es hat Grad N und ist definiert über dem Ring R.
-            h: Das Geheimnis, das verschlüsselt werden soll. Es ist ein Polynom mit Grad N-1 und Koeffizienten, die aus {0, 1, -1} gewählt werden.
-            I: Die Einheitsmatrix der Größe N-1.
-            """
 
-            N1.genPubPriv(name)
+@lru_cache(maxsize=64)
+def _read_pub(filename: str, mtime: int, size: int):
+    E = NTRUencrypt()
+    E.readPub(filename)
+    return E
 
-            if skip_check:
-                finished = True
-                break
 
-            factors = factor_int(N1.h[-1])
-            possible_keys = 2 ** N1.df * (N1.df + 1) ** 2 * 2 ** N1.dg * (N1.dg + 1) * 2 ** N1.dr * (N1.dr + 1)
-            if len(factors) == 0 and possible_keys > 2**80:  # see 'security_check.py' for more information
-                finished = True
-                break
-            print("failed")
-        if not finished:
-            print("[-] Security of keys couldn't get verified.")
+@lru_cache(maxsize=8)
+def _read_priv(filename: str, mtime: int, size: int):
+    D = NTRUdecrypt()
+    D.readPriv(filename)
+    return D
+
+
+def load_public_key(name: str) -> NTRUencrypt:
+    """
+    Load a public key, the parsed key is cached in-process by the path, modification time
+    and size of the file, so it is only read again after the file has changed.
+    :param name: name of key file
+    :return: the key, to be passed to encrypt
+    """
+    stat = os.stat(name + ".pub")
+    return _read_pub(os.path.abspath(name + ".pub"), stat.st_mtime_ns, stat.st_size)
 
 
-def encrypt(name: str, string: str):
+def load_private_key(name: str) -> NTRUdecrypt:
     """
+    Load a private key, cached in the same way as load_public_key.
     :param name: name of key file
+    :return: the key, to be passed to decrypt
+    """
+    stat = os.stat(name + ".priv")
+    return _read_priv(os.path.abspath(name + ".priv"), stat.st_mtime_ns, stat.st_size)
+
+
+def encrypt(name: "str | NTRUencrypt", string: str):
+    """
+    :param name: name of key file, or a key returned by load_public_key
     :param string: message to encrypt as a string
-    :return:
+    :return: the encrypted message in the binary ciphertext format (bytes)
     """
-    E = NTRUencrypt()
-    E.readPub(name + ".pub")
-    E.encryptString(string)
+    E = name if isinstance(name, NTRUencrypt) else load_public_key(name)
 
-    return E.Me
+    return E.encryptString(string)
 
 
-def decrypt(name: str, cipher: str):
+def decrypt(name: "str | NTRUdecrypt", cipher: str):
     """
-    :param name: name of key file
-    :param cipher: encrypted message
-    :return:
+    :param name: name of key file, or a key returned by load_private_key
+    :param cipher: encrypted message, as bytes or in the legacy text format
+    :return: the decrypted message, a ValueError is raised if the message is garbled or
+        was not encrypted for the key
     """
-    D = NTRUdecrypt()
-    D.readPriv(name + ".priv")
-    to_decrypt = cipher
-    D.decryptString(to_decrypt)
+    D = name if isinstance(name, NTRUdecrypt) else load_private_key(name)
 
-    return D.M
+    return D.decryptString(cipher)
 
 
-def generate_keys_ntru(name="key", mode="highest", skip_check=False, debug=False):
+def generate_keys_ntru(name="key", mode="highest", skip_check=False, debug=False, workers=1, seed=None):
     if mode not in ["moderate", "high", "highest"]:
         raise ValueError("Input string must be 'moderate', 'high', or 'highest'")
     """
     :param name: name of file output
     :param mode: moderate, high, highest
+    :param workers: number of processes to try candidate keys in (see find_keys)
+    :param seed: seed for reproducible keys (see find_keys), also seeds the RSA primes
     :return:
     """
     if debug:
@@ -190,29 +279,17 @@ def generate_keys_ntru(name="key", mode="highest", skip_check=False, debug=False
             print("[-] Couldn't generate key, as security couldn't be verified in 10 checks.")
         print("[+] Done.")
     else:
-        finished = False
-        for i in range(10):
-            N1 = NTRUdecrypt()
-            if mode == "moderate":
-                N1.setNpq(N=107, p=3, q=2048, df=15, dg=12, d=5)
-            elif mode == "high":
-                N1.setNpq(N=167, p=3, q=2048, df=61, dg=20, d=18)
-            elif mode == "highest":
-                N1.setNpq(N=503, p=3, q=2048, df=216, dg=72, d=55)
-
-
-            N1.generate_keys_with_rsa(name)
-
-            if skip_check:
-                finished = True
-                break
-
-            factors = factor_int(N1.h[-1])
-            possible_keys = 2 ** N1.df * (N1.df + 1) ** 2 * 2 ** N1.dg * (N1.dg + 1) * 2 ** N1.dr * (N1.dr + 1)
-            if len(factors) == 0 and possible_keys > 2 ** 80:  # see 'security_check.py' for more information
-                finished = True
-                break
-            print("failed")
+        if mode == "moderate":
+            settings = [dict(N=107, p=3, q=2048, df=15, dg=12, d=5)]
+        elif mode == "high":
+            settings = [dict(N=167, p=3, q=2048, df=61, dg=20, d=18)]
+        elif mode == "highest":
+            settings = [dict(N=503, p=3, q=2048, df=216, dg=72, d=55)]
+
+        N1, finished = find_keys(settings, skip_check, workers=workers, seed=seed)
+        if seed is not None:
+            random.seed(seed)
+        N1.generate_keys_with_rsa(name, new_fg=False)
         if not finished:
             print("[-] Security of keys couldn't get verified.")
 
@@ -15,6 +15,7 @@ import os
 import uuid
 import socket
 import pickle
+from multiprocessing.connection import Connection
 from dependencies.modules import pq_ntru
 
 # Define all the paths
@@ -30,28 +31,26 @@ key_path = os.path.join(data_folder_path, str(uuid.getnode()))
 
 # This file supports multiprocessing as it is designed that way
 # to only import kivy in the main process.
-def decrypt_messages(chat: list, other_user_id: str):
+def decrypt_messages(messages: list[bytes], connection: Connection):
     """
-    Decrypts all the new messages in the given chat and saves it in
-    the given user's chat data so that it can be used later.
+    Decrypts the given messages and sends their text back on the given
+    connection, the chat saves them so that they can be used later.
     This function can be run in a different process.
-    :param chat: The chat to decrypt.
-    :param other_user_id: The id of the other user in the chat.
+    :param messages: The encrypted messages.
+    :param connection: The connection to send the texts on, in the
+        order of the messages, None for a message that cannot be
+        decrypted.
     """
-    chat_path = os.path.join(data_folder_path, f'{other_user_id}.dat')
-
-    with open(chat_path, 'rb') as file:
-        saved_chat = pickle.load(file)
-
-    for message in chat:
+    # Load the private key once for all the messages.
+    private_key = pq_ntru.load_private_key(key_path)
+    texts = []
+    for message in messages:
         try:
-            saved_chat[message[0]]
-        except KeyError:
-            if message[1] == other_user_id:
-                saved_chat[message[0]] = pq_ntru.decrypt(key_path, message[0])
-
-    with open(chat_path, 'wb') as file:
-        pickle.dump(saved_chat, file)
+            texts.append(pq_ntru.decrypt(private_key, message))
+        except ValueError:
+            texts.append(None)
+    connection.send(texts)
+    connection.close()
 
 
 if __name__ == '__main__':
@@ -66,7 +65,7 @@ if __name__ == '__main__':
         os.environ['KIVY_NO_CONSOLELOG'] = '1'
     try:
         from dependencies.modules.communicator import send, receive
-        from dependencies.modules.exceptionalthread import ThreadWithExc
+        from dependencies.modules.cancellation import CancellableThread
         from dependencies.modules import kivy_config
         from dependencies.modules.home_screen import HomeScreen
         from kivymd.app import MDApp
@@ -112,7 +111,7 @@ if __name__ == '__main__':
             transition in to the necessary screen.
             """
 
-            loading_thread: ThreadWithExc | None = None
+            loading_thread: CancellableThread | None = None
 
             def on_enter(self, *args):
                 """Executed when the screen is entered."""
@@ -131,7 +130,7 @@ if __name__ == '__main__':
             def load_thread(self):
                 """Function to start loading in a thread."""
                 app_instance.screen_manager.transition = SlideTransition(direction='up')
-                self.loading_thread = ThreadWithExc(target=self.start_loading)
+                self.loading_thread = CancellableThread(target=self.start_loading)
                 Clock.schedule_once(lambda *arg: self.loading_thread.start())
                 self.ids.loader.color = [1, 1, 1, 1]
 
@@ -149,11 +148,15 @@ if __name__ == '__main__':
                         pq_ntru.generate_keys(key_path, 'moderate', True)
 
                     SERVER = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.loading_thread.token.register(SERVER)
                     SERVER.connect(ADDR)
                     # Set the keep alive options for the socket
                     SERVER.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
                     SERVER.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
                     SERVER.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                    # Every message is sent with a single send, so it is
+                    # not held back to be sent with the next one.
+                    SERVER.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
                     send(str(uuid.getnode()), SERVER)
 
@@ -167,10 +170,11 @@ if __name__ == '__main__':
                     else:
                         Clock.schedule_once(
                             lambda *arg: setattr(self.parent, 'current', 'Home'))
-                except SystemExit:
-                    pass
                 except Exception as exception:
-                    self.raise_exc(exception)
+                    # The connection is shut down if the app is closed
+                    # while loading.
+                    if not self.loading_thread.token.cancelled:
+                        self.raise_exc(exception)
 
             @mainthread
             def raise_exc(self, exception: Exception):
@@ -284,6 +288,11 @@ if __name__ == '__main__':
                 text=f'''PeerChat has crashed due to an unexpected exception\nException"{
                 error}"''', title='Error', button='OK')
 
+    try:
+        if app_instance.screen_manager.ids.Splash.loading_thread:  # noqa
+            app_instance.screen_manager.ids.Splash.loading_thread.stop()  # noqa
+    except AttributeError:
+        pass
     try:
         app_instance.screen_manager.ids.Home.__delete__()  # noqa
     except AttributeError:
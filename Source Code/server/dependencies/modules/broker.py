@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the broker between the worker
+processes of the server.
+When the server is started with several workers, every user belongs to
+the worker their address is sharded to, see get_shard. The broker keeps
+the directory of all the users, so usernames are unique and searched
+across the workers, and routes the chats and messages between users on
+different workers to the worker of the user they are for.
+The workers are connected to the broker with Unix domain sockets, every
+frame between them is tagged (see communicator.tag) with its kind and
+the id of the user it is for, or the id of the request it belongs to.
+"""
+
+import zlib
+import asyncio
+import logging
+from dependencies.modules.communicator import receive_async, tag, untag  # noqa
+from dependencies.modules import codec  # noqa
+from dependencies.modules.chat_store import USER_RECORD  # noqa
+from dependencies.modules.username_index import UsernameIndex  # noqa
+from dependencies.modules.outbound_queue import OutboundQueue, BLOCK  # noqa
+
+# Kinds of the frames between the workers and the broker.
+USER = b'U'  # A new user or a changed username, tagged with the user's id.
+CLAIM = b'N'  # Request to reserve a username for a user.
+RELEASE = b'F'  # Frees a username reserved by a user, tagged with the user's id.
+SEARCH = b'S'  # Request to search the usernames.
+GET = b'G'  # Request for the details of a user.
+CHAT = b'C'  # A new chat, tagged with the id of the user it was started with.
+MESSAGE = b'M'  # A message in a chat, tagged with the id of the user it is for.
+REPLY = b'A'  # The reply to a request.
+# Kinds of the frames that are routed to the worker of the user they are
+# tagged with.
+routed = (CHAT, MESSAGE)
+
+# Username and id of the user reserving it.
+CLAIM_REQUEST = codec.Record(codec.Text('H'), codec.Id())
+# Text to search for, maximum number of results and username to leave out.
+SEARCH_REQUEST = codec.Record(codec.Text('H'), codec.Integer('H'), codec.Text('H'))
+# The user details, none if there is no user with the id.
+GET_REPLY = codec.List(USER_RECORD)
+# Id of the user of the sending worker in the chat, and the message.
+MESSAGE_RELAY = codec.Record(codec.Id(), codec.MESSAGE)
+# Maximum number of frames waiting to be sent to a worker, the frames
+# from the other workers wait for space instead of being dropped.
+queue_size = 4096
+
+
+def get_shard(address: str, workers: int) -> int:
+    """
+    Gets the worker a client belongs to.
+    Both connections of a client come from the same address and have to
+    be paired by the same worker, so the clients are sharded by address.
+    :param address: Ip address of the client.
+    :param workers: Number of workers.
+    :return: Index of the worker.
+    """
+    return zlib.crc32(address.encode()) % workers
+
+
+class Broker:
+    """Main class for the broker between the worker processes."""
+
+    def __init__(self, workers: int):
+        """
+        :param workers: Number of workers.
+        """
+        self.workers = workers
+        # Details of all the users by their id, see USER_RECORD.
+        self.users: dict[str, tuple] = {}
+        # Ids of the users by their username, and the usernames
+        # reserved by users that have not been added or renamed yet.
+        self.usernames: dict[str, str] = {}
+        self.claims: dict[str, str] = {}
+        self.username_index = UsernameIndex()
+        self.queues: list[OutboundQueue | None] = [None] * workers
+
+    async def serve(self, connections: list):
+        """
+        Serves the workers until one of them stops or the broker is
+        cancelled, the connections stay open until it is closed.
+        :param connections: Sockets connected to the workers, in order.
+        """
+        streams = [await asyncio.open_connection(sock=connection) for connection in connections]
+        for worker, (_, writer) in enumerate(streams):
+            self.queues[worker] = OutboundQueue(writer, queue_size, BLOCK)
+        tasks = [asyncio.create_task(self.handle_worker(worker, reader))
+                 for worker, (reader, _) in enumerate(streams)]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self):
+        """Closes the connections to the workers."""
+        for queue in self.queues:
+            if queue:
+                queue.close()
+
+    async def handle_worker(self, worker: int, reader: asyncio.StreamReader):
+        """
+        Handles the frames from a worker.
+        :param worker: Index of the worker.
+        :param reader: Stream to receive the frames from.
+        """
+        try:
+            while True:
+                frame = await receive_async(reader, False)
+                kind, _id, message = untag(frame)
+                if kind in routed:
+                    user = self.users.get(_id)
+                    if user:
+                        await self.queues[get_shard(user[1], self.workers)].put(frame)
+                elif kind == USER:
+                    await self.add_user(worker, frame, USER_RECORD.loads(message))
+                elif kind == CLAIM:
+                    await self.reply(worker, _id, codec.Bool().dumps(
+                        self.claim(*CLAIM_REQUEST.loads(message))))
+                elif kind == RELEASE:
+                    self.release(_id)
+                elif kind == SEARCH:
+                    text, limit, exclude = SEARCH_REQUEST.loads(message)
+                    await self.reply(worker, _id, codec.USERS.dumps(
+                        [(username, self.usernames[username]) for username in
+                         self.username_index.search(text, limit, exclude or None)]))
+                elif kind == GET:
+                    user = self.users.get(codec.Id().loads(message))
+                    await self.reply(worker, _id, GET_REPLY.dumps([user] if user else []))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error(f'Worker {worker} disconnected from the broker')
+
+    async def reply(self, worker: int, request_id: str, message: bytes):
+        """
+        Replies to a request from a worker.
+        :param worker: Index of the worker.
+        :param request_id: Id of the request.
+        :param message: The reply.
+        """
+        await self.queues[worker].put(tag(REPLY, request_id, message))
+
+    def claim(self, username: str, _id: str) -> bool:
+        """
+        Reserves a username for a user, until the user is added or
+        renamed with it.
+        :param username: The username.
+        :param _id: Id of the user.
+        :return: Whether the username was free.
+        """
+        if self.usernames.get(username, _id) != _id or self.claims.get(username, _id) != _id:
+            return False
+        # A user only reserves one username at a time.
+        self.release(_id)
+        self.claims[username] = _id
+        return True
+
+    def release(self, _id: str):
+        """
+        Frees the username reserved by a user.
+        :param _id: Id of the user.
+        """
+        for username, claim_id in self.claims.items():
+            if claim_id == _id:
+                del self.claims[username]
+                break
+
+    async def add_user(self, worker: int, frame: bytes, user: tuple):
+        """
+        Adds a user to the directory, or changes their username. The
+        other workers are told about a changed username, so they update
+        the chats they have with the user.
+        :param worker: Index of the worker the user belongs to.
+        :param frame: The frame with the user.
+        :param user: The user details, see USER_RECORD.
+        """
+        _id, username = user[0], user[3]
+        self.claims.pop(username, None)
+        old_user = self.users.get(_id)
+        self.users[_id] = user
+        if old_user and old_user[3] == username:
+            return
+        if old_user:
+            del self.usernames[old_user[3]]
+            self.username_index.remove(old_user[3])
+        self.usernames[username] = _id
+        self.username_index.add(username)
+        if old_user:
+            for other_worker, queue in enumerate(self.queues):
+                if other_worker != worker:
+                    await queue.put(frame)
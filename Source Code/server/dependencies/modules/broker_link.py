@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the connection of a worker process
+of the server to the broker, see broker.Broker.
+"""
+
+import asyncio
+import itertools
+import logging
+from typing import Awaitable, Callable
+from dependencies.modules.communicator import receive_async, tag, untag, header  # noqa
+from dependencies.modules import codec  # noqa
+from dependencies.modules.chat_store import USER_RECORD, user_fields  # noqa
+from dependencies.modules.broker import (USER, CLAIM, RELEASE, SEARCH, GET, CHAT, MESSAGE,  # noqa
+                                         REPLY, CLAIM_REQUEST, SEARCH_REQUEST, GET_REPLY,
+                                         MESSAGE_RELAY, queue_size)
+from dependencies.modules.outbound_queue import OutboundQueue, BLOCK  # noqa
+
+
+class BrokerLink:
+    """Main class for the connection of a worker to the broker."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 handlers: dict[bytes, Callable[[str, memoryview], Awaitable]]):
+        """
+        :param reader: Stream to receive from the broker.
+        :param writer: Stream to send to the broker.
+        :param handlers: Functions to handle the frames the broker sends
+            by their kind, they are called with the id the frame is
+            tagged with and the frame.
+        """
+        self.reader = reader
+        self.writer = writer
+        # The frames to the broker are queued so the frames sent during
+        # the same loop iteration are written together, they wait for
+        # space instead of being dropped.
+        self.queue = OutboundQueue(writer, queue_size, BLOCK)
+        self.handlers = handlers
+        # The replies to the requests are matched to them by their id.
+        self.requests: dict[str, asyncio.Future] = {}
+        self.request_ids = itertools.count()
+        self.task = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        """Receives the frames from the broker until it disconnects."""
+        try:
+            while True:
+                kind, _id, message = untag(await receive_async(self.reader, False))
+                if kind == REPLY:
+                    future = self.requests.pop(_id, None)
+                    if future and not future.done():
+                        future.set_result(message)
+                elif kind in self.handlers:
+                    try:
+                        await self.handlers[kind](_id, message)
+                    except Exception as error:
+                        logging.warning('broker: ' + str(error))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error('Disconnected from the broker')
+        finally:
+            for future in self.requests.values():
+                future.cancel()
+
+    async def send(self, kind: bytes, _id: str, message: bytes = b''):
+        """
+        Sends a frame to the broker.
+        :param kind: Kind of the frame.
+        :param _id: Id the frame is tagged with.
+        :param message: The frame.
+        """
+        await self.queue.put(tag(kind, _id, message))
+
+    async def request(self, kind: bytes, message: bytes) -> memoryview:
+        """
+        Sends a request to the broker and waits for the reply.
+        :param kind: Kind of the request.
+        :param message: The request.
+        :return: The reply.
+        """
+        # The ids only need to be unique in this worker, they are
+        # padded to the length of the tag.
+        request_id = f'{next(self.request_ids):036d}'
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request_id] = future
+        try:
+            await self.send(kind, request_id, message)
+            return await future
+        finally:
+            self.requests.pop(request_id, None)
+
+    async def add_user(self, user: dict):
+        """
+        Adds a user of this worker to the directory of the broker, or
+        changes their username.
+        :param user: The user.
+        """
+        await self.send(USER, user['id'],
+                        USER_RECORD.dumps(tuple(user[field] for field in user_fields)))
+
+    async def claim(self, username: str, _id: str) -> bool:
+        """
+        Reserves a username for a user across the workers.
+        :param username: The username.
+        :param _id: Id of the user.
+        :return: Whether the username was free.
+        """
+        return codec.Bool().loads(await self.request(CLAIM, CLAIM_REQUEST.dumps((username, _id))))
+
+    def release(self, _id: str):
+        """
+        Frees the username reserved by a user that was not added, it
+        does not wait for the frame to be sent so it can be used while
+        the task of the user is being cancelled.
+        :param _id: Id of the user.
+        """
+        frame = tag(RELEASE, _id)
+        self.writer.write(header.pack(len(frame)) + frame)
+
+    async def search(self, text: str, limit: int, exclude: str | None = None) -> list:
+        """
+        Searches the usernames of the users of all the workers, see
+        UserRegistry.search.
+        :param text: The text to search for.
+        :param limit: Maximum number of users to return.
+        :param exclude: Username to leave out of the results.
+        :return: Username and id of the users.
+        """
+        return codec.USERS.loads(await self.request(SEARCH, SEARCH_REQUEST.dumps(
+            (text, limit, exclude or ''))))
+
+    async def get_user(self, _id: str) -> dict | None:
+        """
+        Gets a user of any worker by their id.
+        :param _id: Id of the user.
+        :return: The user details, see user_fields, or None if there is
+            no user with the id.
+        """
+        try:
+            request = codec.Id().dumps(_id)
+        except ValueError:
+            return None
+        users = GET_REPLY.loads(await self.request(GET, request))
+        return dict(zip(user_fields, users[0])) if users else None
+
+    async def add_chat(self, user_1: dict, user_2: str):
+        """
+        Tells the worker of a user about a chat started with them.
+        :param user_1: The user that started the chat.
+        :param user_2: Id of the other user.
+        """
+        await self.send(CHAT, user_2,
+                        USER_RECORD.dumps(tuple(user_1[field] for field in user_fields)))
+
+    async def relay_message(self, user_2: str, user_1: str, message: tuple):
+        """
+        Sends a message to the copy of its chat on the worker of a user.
+        :param user_2: Id of the user of the other worker.
+        :param user_1: Id of the user of this worker in the chat.
+        :param message: The message.
+        """
+        await self.send(MESSAGE, user_2, MESSAGE_RELAY.dumps((user_1, message)))
+
+    def close(self):
+        """Closes the connection to the broker."""
+        self.task.cancel()
+        self.queue.close()
@@ -6,161 +6,194 @@ at once on the server side.
 """
 
 from datetime import datetime
-import socket
-import pickle
 import logging
 import pytz
-from dependencies.modules.communicator import send, receive  # noqa
-from dependencies.modules.exceptionalthread import ThreadWithExc  # noqa
-from random_open_port import random_port
+from dependencies.modules.communicator import tag, CHAT, MESSAGE, READ  # noqa
+from dependencies.modules import codec  # noqa
+from dependencies.modules.chat_history import ChatHistory, history_size  # noqa
+from dependencies.modules.chat_store import ChatStore  # noqa
+from dependencies.modules.outbound_queue import OutboundQueue  # noqa
+from dependencies.modules.broker_link import BrokerLink  # noqa
+
+# Number of the latest messages sent to a user when they connect to a
+# chat.
+reconnect_messages = history_size
 
 
 class Chat:
     """Main class for a chat on the server."""
 
-    def __init__(self, user_1: dict, user_2: dict):
+    def __init__(self, user_1: dict, user_2: dict, size: int = history_size,
+                 store: ChatStore | None = None, broker: BrokerLink | None = None):
         self.user_1 = user_1
-        self.chat_server_user_1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.user_2 = user_2
-        self.chat_server_user_2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.user_1_port = random_port()
-        self.chat_server_user_1.bind(('', self.user_1_port))
-        self.chat_server_user_1.listen()
-        self.user_2_port = random_port()
-        self.chat_server_user_2.bind(('', self.user_2_port))
-        self.chat_server_user_2.listen()
-        self.chat: list = []
-        self.listen_user_1_thread: ThreadWithExc = None
-        self.listen_user_2_thread: ThreadWithExc = None
-        self.listen_message_user_1_thread: ThreadWithExc = None
-        self.listen_message_user_2_thread: ThreadWithExc = None
+        # The changes to the chat are stored if the server has a store.
+        self.store = store
+        # If the server has several workers and the users belong to
+        # different workers, both workers have a copy of the chat and
+        # the messages are relayed between them through the broker.
+        self.broker = broker
+        # Outbound queues of the chat connections of the users, all the
+        # chats of a user are multiplexed over the same connection so
+        # they are not owned by the chat, see connect_user.
+        self.user_1_socket: OutboundQueue | None = None
+        self.user_2_socket: OutboundQueue | None = None
+        self.chat = ChatHistory(size)
         self.user_1_unread = False
         self.user_2_unread = False
 
     def __delete__(self):
         """Deletes the chat object."""
-        for thread in [self.listen_user_1_thread, self.listen_user_2_thread,
-                       self.listen_message_user_1_thread, self.listen_message_user_2_thread]:
-            if thread:
-                thread.raiseExc(SystemExit)
+        self.user_1_socket = None
+        self.user_2_socket = None
+
+    def get_other_user(self, _id: str) -> dict:
+        """
+        Gets the other user in the chat.
+        :param _id: Id of a user in the chat.
+        :return: The user in the chat that does not have the given id.
+        """
+        return self.user_2 if self.user_1['id'] == _id else self.user_1
+
+    @property
+    def sequence(self) -> int:
+        """Number of the last message in the chat, 0 if it has none."""
+        return self.chat[-1][3] if len(self.chat) else 0
 
-    def connect_user(self, user):
+    async def connect_user(self, user: dict, last_seen: int = 0):
         """
         Connects a user to the chat.
         :param user: The user to be connected to the chat.
+        :param last_seen: Number of the last message of the chat the
+            user already has, only the messages after it are sent.
         """
+        # The chat is sent to the user when they reconnect if they
+        # are not connected.
+        if not user.get('socket'):
+            return
         try:
-            # Send the port to the user to connect to the
-            # chat connection with the server, Then listen
-            # to the user for a connection with the chat
-            # server.
             if self.user_1['id'] == user['id']:
-                send(str(self.user_1_port), user['socket'])
-                self.listen_user_1_thread = ThreadWithExc(
-                    target=self.listen_user, args=(user,))
-                self.listen_user_1_thread.start()
+                unread = self.user_1_unread
+                self.user_1_socket = user['socket']
             elif self.user_2['id'] == user['id']:
-                send(str(self.user_2_port), user['socket'])
-                self.listen_user_2_thread = ThreadWithExc(
-                    target=self.listen_user, args=(user,))
-                self.listen_user_2_thread.start()
-        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
-            pass
+                unread = self.user_2_unread
+                self.user_2_socket = user['socket']
+            else:
+                return
+            other_user = self.get_other_user(user['id'])
+            # The messages of the chat are numbered without gaps, so the
+            # ones the user missed are the latest ones.
+            missed = max(0, min(self.sequence - last_seen, reconnect_messages))
+            # Send the other user's details, the user that started the
+            # chat, the unread status and the missed messages to the
+            # user on their chat connection, tagged with the other
+            # user's id.
+            await user['socket'].put(tag(CHAT, other_user['id'], codec.CHAT.dumps(
+                ((other_user['username'], other_user['key'], other_user['id']),
+                 self.user_1['id'], unread, self.chat.last(missed)))))
         except Exception as error:
             logging.warning('connect_user: ' + str(error))
 
-    def listen_user(self, user: dict):
+    def disconnect_user(self, user: dict, queue: OutboundQueue):
         """
-        Listens to a user for a connection with the chat server.
-        :param user: The user to listen to for a connection.
+        Disconnects a user from the chat, unless the user has already
+        reconnected with another connection.
+        :param user: The user to be disconnected from the chat.
+        :param queue: Outbound queue of the chat connection of the user
+            to be closed.
         """
-        try:
+        if self.user_1['id'] == user['id'] and self.user_1_socket is queue:
+            self.user_1_socket = None
+        elif self.user_2['id'] == user['id'] and self.user_2_socket is queue:
+            self.user_2_socket = None
+
+    async def receive_message(self, user: dict, kind: bytes, message: bytes):
+        """
+        Handles a message from a user in the chat.
+        :param user: The user that sent the message.
+        :param kind: Kind of the message, CHAT, MESSAGE or READ.
+        :param message: The message, a binary ciphertext.
+        """
+        # The messages on a slow chat connection can be dropped (see
+        # OutboundQueue), the client then asks for the chat again from
+        # its last message.
+        if kind == CHAT:
+            await self.connect_user(user, codec.LAST_SEEN.loads(message))
+            return
+        if kind == READ:
             if user['id'] == self.user_1['id']:
-                chat_server = self.chat_server_user_1
-                other_user = self.user_2
-                unread = self.user_1_unread
+                self.user_1_unread = False
             else:
-                chat_server = self.chat_server_user_2
-                other_user = self.user_1
-                unread = self.user_2_unread
-            while True:
-                connection = chat_server.accept()
-                if connection[1][0] == user['address']:
-                    user['socket'] = connection[0]
-
-                    # Send the other user's details to the user.
-                    send(pickle.dumps((other_user['username'], other_user['key'],
-                                       other_user['id'])), user['socket'], False)
-                    # Send the user that started the chat.
-                    send(self.user_1['id'], user['socket'])
-                    # Send the unread status to the user.
-                    send(pickle.dumps(unread), user['socket'], False)
+                self.user_2_unread = False
+            if self.store:
+                self.store.read(self.user_1['id'], self.user_2['id'], user['id'])
+            return
+        if kind != MESSAGE:
+            return
+        message = (message, user['id'], datetime.now(
+            pytz.timezone("Asia/Kolkata")).strftime('%D::%H:%M'), 0)
+        # The messages are numbered by the worker of the user that
+        # started the chat, so both copies of the chat number them the
+        # same. The message is added to this copy when it is relayed
+        # back with its number.
+        if self.user_1.get('remote'):
+            await self.broker.relay_message(self.user_1['id'], user['id'], message)
+        else:
+            await self.add_message(message)
 
-                    # Send the existing chat to the user.
-                    if self.chat:
-                        # Send 1 to indicate that the chat exists.
-                        send('1', user['socket'])
-                        send(pickle.dumps(self.chat), user['socket'], False)
-                    else:
-                        # Send 1 to indicate that the chat exists.
-                        send('0', user['socket'])
-
-                    # Listen to the user for a message.
-                    thread = ThreadWithExc(target=self.listen_message, args=(user,))
-                    thread.start()
+    async def receive_relayed_message(self, message: tuple):
+        """
+        Handles a message relayed from the worker of the other user in
+        the chat, see receive_message and add_message.
+        :param message: The message, with its sender, time and number,
+            which is 0 if this worker has to number it.
+        """
+        if message[3]:
+            self.append_message(message)
+            await self.send_message(message)
+        else:
+            await self.add_message(message)
 
-                    if user['id'] == self.user_1['id']:
-                        self.user_1 = user
-                        if self.listen_message_user_1_thread:
-                            self.listen_message_user_1_thread.raiseExc(SystemExit)
-                        self.listen_message_user_1_thread = thread
-                    else:
-                        self.user_2 = user
-                        if self.listen_message_user_2_thread:
-                            self.listen_message_user_2_thread.raiseExc(SystemExit)
-                        self.listen_message_user_2_thread = thread
-                    break
-        except (SystemExit, BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
-            pass
-        except Exception as error:
-            logging.warning('listen_user: ' + str(error))
+    async def add_message(self, message: tuple):
+        """
+        Numbers a message and adds it to the chat, then sends it to the
+        users. If one of the users belongs to another worker, the
+        message is relayed to its copy of the chat.
+        :param message: The message, with its sender and time.
+        """
+        message = (*message[:3], self.sequence + 1)
+        self.append_message(message)
+        for user, other_user in ((self.user_1, self.user_2), (self.user_2, self.user_1)):
+            if user.get('remote'):
+                await self.broker.relay_message(user['id'], other_user['id'], message)
+        await self.send_message(message)
 
-    def listen_message(self, user: dict):
-        """
-        Listens to a user for a message.
-        :param user:
-        """
-        while True:
-            try:
-                message = receive(user['socket'])
-                if message == '__170523Read170523__':
-                    if user['id'] == self.user_1['id']:
-                        self.user_1_unread = False
-                    else:
-                        self.user_2_unread = False
-                    continue
-                self.add_message(message, user['id'])
-                if user['id'] == self.user_1['id']:
-                    self.user_2_unread = True
-                    _user = self.user_2
-                else:
-                    self.user_1_unread = True
-                    _user = self.user_1
-                send(pickle.dumps(self.chat[-1]), _user['socket'], False)
-            except SystemExit:
-                break
-            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
-                pass
-            except Exception as error:
-                logging.warning('listen_message: ' + str(error))
+    async def send_message(self, message: tuple):
+        """
+        Sends a message to the users of the chat connected to this
+        worker. The sender gets it too, so they know its number.
+        :param message: The message, with its sender, time and number.
+        """
+        frame = codec.MESSAGE.dumps(message)
+        # A user gets the message with the missed messages if they are
+        # not connected to the chat. The message is queued, so a slow
+        # connection of one user does not hold up the other, see
+        # OutboundQueue.
+        for user, socket in ((self.user_1, self.user_1_socket),
+                             (self.user_2, self.user_2_socket)):
+            if socket:
+                await socket.put(tag(MESSAGE, self.get_other_user(user['id'])['id'], frame))
 
-    def add_message(self, message: str, _id: str):
+    def append_message(self, message: tuple):
         """
-        Adds a message to the chat.
-        :param message: The message to be added.
-        :param _id: Message sender's id.
+        Appends a message to the history of the chat and stores it.
+        :param message: The message, with its sender, time and number.
         """
-        self.chat.append((message, _id,
-                          datetime.now(pytz.timezone("Asia/Kolkata")).strftime('%D::%H:%M')))
-        if len(self.chat) > 100:
-            self.chat.pop(0)
+        self.chat.append(message)
+        # The message is unread by the user that did not send it.
+        if message[1] == self.user_1['id']:
+            self.user_2_unread = True
+        else:
+            self.user_1_unread = True
+        if self.store:
+            self.store.add_message(self.user_1['id'], self.user_2['id'], message)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the history of the messages in a
+chat.
+The history is a ring buffer, so adding a message when the history is
+full drops the oldest message without moving the other messages.
+"""
+
+# Default maximum number of messages in the history of a chat.
+history_size = 100
+
+
+class ChatHistory:
+    """Main class for the history of the messages in a chat."""
+
+    def __init__(self, size: int = history_size):
+        if size < 1:
+            raise ValueError('The size of the history must be at least 1.')
+        self.size = size
+        self.messages: list = [None] * size
+        # Index of the oldest message in the buffer.
+        self.start = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.messages[(self.start + i) % self.size]
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('Chat history index out of range.')
+        return self.messages[(self.start + index) % self.size]
+
+    def append(self, message):
+        """
+        Adds a message to the history, dropping the oldest message if
+        the history is full.
+        :param message: The message.
+        """
+        self.messages[(self.start + self.length) % self.size] = message
+        if self.length < self.size:
+            self.length += 1
+        else:
+            self.start = (self.start + 1) % self.size
+
+    def last(self, k: int) -> list:
+        """
+        Gets the latest messages, without copying the rest of the
+        history.
+        :param k: Number of messages.
+        :return: The latest k messages, oldest first.
+        """
+        k = max(0, min(k, self.length))
+        start = (self.start + self.length - k) % self.size
+        end = start + k
+        if end <= self.size:
+            return self.messages[start:end]
+        return self.messages[start:] + self.messages[:end - self.size]
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the persistent store of the users
+and chats on the server.
+Every change is appended as a record to a log that is split into
+segments, the records are written and synced to the disk in batches
+(group commit). When the log has grown to the size of the last
+snapshot, a snapshot of the users and chats is written in a worker
+thread, a new segment is started and the older segments are deleted, so
+only the records after the snapshot are replayed when the server
+restarts.
+"""
+
+import os
+import zlib
+import struct
+import asyncio
+import logging
+import threading
+from dependencies.modules import codec  # noqa
+from dependencies.modules.chat_history import ChatHistory, history_size  # noqa
+
+# Minimum size in bytes of the log before a snapshot is written.
+segment_size = 16 * 1024 * 1024
+# A snapshot is written when the log has grown to this many times the
+# size of the last snapshot, so writing the snapshots at most doubles
+# the writes however many chats there are.
+snapshot_ratio = 1
+# Time in seconds the records are collected for before they are written
+# and synced to the disk together.
+commit_interval = 0.005
+
+# Kinds of the records in the log.
+USER = b'U'  # A new user or a changed username.
+CHAT = b'C'  # A new chat.
+MESSAGE = b'M'  # A message in a chat.
+READ = b'R'  # A chat has been read by a user.
+
+# Id, address, mac, username and public key of a user.
+user_fields = ('id', 'address', 'mac', 'username', 'key')
+USER_RECORD = codec.Record(codec.Id(), codec.Text('H'), codec.Text('H'), codec.Text('H'),
+                           codec.Text())
+# Ids of the users in a chat, the first one started the chat.
+CHAT_RECORD = codec.Record(codec.Id(), codec.Id())
+MESSAGE_RECORD = codec.Record(codec.Id(), codec.Id(), codec.MESSAGE)
+# Ids of the users in the chat and the id of the user that read it.
+READ_RECORD = codec.Record(codec.Id(), codec.Id(), codec.Id())
+records = {USER: USER_RECORD, CHAT: CHAT_RECORD, MESSAGE: MESSAGE_RECORD, READ: READ_RECORD}
+# Sequence number of the last record in the snapshot, the users, and the
+# chats with the unread status of both users and the messages.
+SNAPSHOT = codec.Record(codec.Integer(), codec.List(USER_RECORD), codec.List(codec.Record(
+    codec.Id(), codec.Id(), codec.Bool(), codec.Bool(), codec.List(codec.MESSAGE))))
+
+# A record is its length, sequence number and kind, the record itself,
+# and the crc32 of all of them.
+record_header = struct.Struct('>IQc')
+record_checksum = struct.Struct('>I')
+
+
+class ChatStore:
+    """Main class for the persistent store of the users and chats."""
+
+    def __init__(self, path: str, size: int = history_size):
+        """
+        :param path: Folder to keep the store in.
+        :param size: Maximum number of messages kept for each chat.
+        """
+        self.path = path
+        self.size = size
+        self.log_path = os.path.join(path, 'log')
+        self.snapshot_path = os.path.join(path, 'snapshot.dat')
+        os.makedirs(self.log_path, exist_ok=True)
+        # The state of the users and chats the records add up to.
+        self.users: dict[str, dict] = {}
+        self.chats: dict[tuple[str, str], dict] = {}
+        # Sequence numbers of the last record, and of the last record
+        # written to the log.
+        self.sequence = 0
+        self.written_sequence = 0
+        self.segment = None
+        # Sizes in bytes of the log since the last snapshot, and of the
+        # last snapshot.
+        self.log_size = 0
+        self.snapshot_size = 0
+        # The log is written from a worker thread, the lock keeps a new
+        # segment from being started while writing.
+        self.segment_lock = threading.Lock()
+        self.pending: list[bytes] = []
+        self.commit_handle: asyncio.TimerHandle | None = None
+        self.commit_task: asyncio.Task | None = None
+
+    def get_segments(self) -> list[tuple[int, str]]:
+        """
+        Gets the segments of the log.
+        :return: Sequence number of the first record and path of the
+            segments, in order.
+        """
+        return [(int(name[:-4]), os.path.join(self.log_path, name))
+                for name in sorted(os.listdir(self.log_path)) if name.endswith('.log')]
+
+    def open_segment(self) -> str:
+        """
+        Starts a new segment of the log.
+        :return: Path of the segment.
+        """
+        # The segments are named by the sequence number of their first
+        # record, so the segments to replay are found by their names.
+        path = os.path.join(self.log_path, f'{self.written_sequence + 1:020d}.log')
+        with self.segment_lock:
+            if self.segment:
+                self.segment.close()
+            self.segment = open(path, 'ab')
+        return path
+
+    def load(self) -> tuple[dict[str, dict], dict[tuple[str, str], dict]]:
+        """
+        Loads the users and chats from the snapshot and the records
+        after it.
+        :return: The users by their id, and the chats by the ids of
+            their users with their 'unread' status and 'chat' history.
+        """
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as file:
+                data = file.read()
+            self.snapshot_size = len(data)
+            self.sequence, users, chats = SNAPSHOT.loads(data)
+            for user in users:
+                self.users[user[0]] = dict(zip(user_fields, user))
+            for user_1, user_2, unread_1, unread_2, messages in chats:
+                history = ChatHistory(self.size)
+                for message in messages:
+                    history.append(message)
+                self.chats[(user_1, user_2)] = {'unread': [unread_1, unread_2], 'chat': history}
+
+        segments = self.get_segments()
+        start = 0
+        for i, (first_sequence, _) in enumerate(segments):
+            if first_sequence <= self.sequence + 1:
+                start = i
+        # The segments before the one with the first record after the
+        # snapshot are left if the server stopped while writing it.
+        for _, segment_path in segments[:start]:
+            os.remove(segment_path)
+        for i, (_, segment_path) in enumerate(segments[start:], start):
+            self.replay(segment_path, i == len(segments) - 1)
+            self.log_size += os.path.getsize(segment_path)
+
+        self.written_sequence = self.sequence
+        self.open_segment()
+        logging.info(f'Store loaded({len(self.users)} users, {len(self.chats)} chats)')
+        return self.users, self.chats
+
+    def replay(self, path: str, last: bool):
+        """
+        Applies the records in a segment of the log that are not in the
+        snapshot.
+        :param path: Path of the segment.
+        :param last: Whether it is the last segment, a record that was
+            being written when the server stopped is removed from it.
+        """
+        with open(path, 'rb') as file:
+            data = memoryview(file.read())
+        offset = 0
+        while offset < len(data):
+            try:
+                if offset + record_header.size > len(data):
+                    raise ValueError('Truncated record header.')
+                length, sequence, kind = record_header.unpack_from(data, offset)
+                end = offset + record_header.size + length
+                if end + record_checksum.size > len(data):
+                    raise ValueError('Truncated record.')
+                if zlib.crc32(data[offset:end]) != record_checksum.unpack_from(data, end)[0]:
+                    raise ValueError('Corrupted record.')
+                if sequence > self.sequence:
+                    self.apply(kind, records[kind].loads(data[offset + record_header.size:end]))
+                    self.sequence = sequence
+            except (ValueError, KeyError) as error:
+                logging.warning(f'replay: {path} at {offset}: {error}')
+                if last:
+                    os.truncate(path, offset)
+                return
+            offset = end + record_checksum.size
+
+    def apply(self, kind: bytes, record: tuple):
+        """
+        Applies a record to the state of the users and chats.
+        :param kind: Kind of the record.
+        :param record: The record.
+        """
+        if kind == USER:
+            self.users[record[0]] = dict(zip(user_fields, record))
+        elif kind == CHAT:
+            self.chats[record] = {'unread': [False, False], 'chat': ChatHistory(self.size)}
+        elif kind == MESSAGE:
+            chat = self.chats[record[:2]]
+            chat['chat'].append(record[2])
+            # The message is unread by the user that did not send it.
+            chat['unread'][0 if record[2][1] == record[1] else 1] = True
+        elif kind == READ:
+            chat = self.chats[record[:2]]
+            chat['unread'][0 if record[2] == record[0] else 1] = False
+
+    def append(self, kind: bytes, record: tuple):
+        """
+        Appends a record to the log, it is written to the disk with the
+        other records appended within commit_interval.
+        :param kind: Kind of the record.
+        :param record: The record.
+        """
+        self.apply(kind, record)
+        self.sequence += 1
+        data = records[kind].dumps(record)
+        data = record_header.pack(len(data), self.sequence, kind) + data
+        self.pending.append(data + record_checksum.pack(zlib.crc32(data)))
+        if not self.commit_handle and not self.commit_task:
+            self.commit_handle = asyncio.get_running_loop().call_later(commit_interval,
+                                                                       self.start_commit)
+
+    def add_user(self, user: dict):
+        """
+        Stores a new user or the new username of a user.
+        :param user: The user.
+        """
+        self.append(USER, tuple(user[field] for field in user_fields))
+
+    def add_chat(self, user_1: str, user_2: str):
+        """
+        Stores a new chat.
+        :param user_1: Id of the user that started the chat.
+        :param user_2: Id of the other user.
+        """
+        self.append(CHAT, (user_1, user_2))
+
+    def add_message(self, user_1: str, user_2: str, message: tuple):
+        """
+        Stores a message in a chat.
+        :param user_1: Id of the user that started the chat.
+        :param user_2: Id of the other user.
+        :param message: The message.
+        """
+        self.append(MESSAGE, (user_1, user_2, message))
+
+    def read(self, user_1: str, user_2: str, _id: str):
+        """
+        Stores that a chat has been read by a user.
+        :param user_1: Id of the user that started the chat.
+        :param user_2: Id of the other user.
+        :param _id: Id of the user that read the chat.
+        """
+        self.append(READ, (user_1, user_2, _id))
+
+    def start_commit(self):
+        """Starts writing the pending records."""
+        self.commit_handle = None
+        self.commit_task = asyncio.create_task(self.commit())
+
+    async def commit(self):
+        """
+        Writes the pending records to the log and syncs them to the
+        disk, the records appended while writing are written in the
+        next batch.
+        """
+        try:
+            while self.pending:
+                data = b''.join(self.pending)
+                sequence = self.sequence
+                self.pending = []
+                await asyncio.to_thread(self.write, data)
+                self.written_sequence = sequence
+                self.log_size += len(data)
+                if self.log_size >= max(segment_size, snapshot_ratio * self.snapshot_size):
+                    await self.write_snapshot()
+        except OSError as error:
+            logging.error('commit: ' + str(error))
+        finally:
+            self.commit_task = None
+
+    def write(self, data: bytes):
+        """
+        Writes data to the log and syncs it to the disk.
+        :param data: The data.
+        """
+        with self.segment_lock:
+            self.segment.write(data)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+    async def write_snapshot(self):
+        """
+        Writes a snapshot of the users and chats, starts a new segment
+        and deletes the older segments.
+        """
+        # The snapshot has the pending records too, they are skipped
+        # when the new segment is replayed. The state is copied here
+        # and packed in the worker thread, so the server is not held up
+        # while the snapshot is packed.
+        snapshot = (self.sequence, [tuple(user[field] for field in user_fields)
+                                    for user in self.users.values()],
+                    [(*chat_id, *chat['unread'], chat['chat'].last(len(chat['chat'])))
+                     for chat_id, chat in self.chats.items()])
+        path = self.open_segment()
+        self.log_size = 0
+        self.snapshot_size = await asyncio.to_thread(self.save_snapshot, snapshot, [
+            segment_path for _, segment_path in self.get_segments() if segment_path != path])
+
+    def save_snapshot(self, snapshot: tuple, segments: list[str]) -> int:
+        """
+        Replaces the snapshot and deletes the segments it covers.
+        :param snapshot: The sequence number of the last record, the
+            users and the chats, see SNAPSHOT.
+        :param segments: Paths of the segments in the snapshot.
+        :return: Size of the snapshot in bytes.
+        """
+        data = SNAPSHOT.dumps(snapshot)
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        for path in segments:
+            os.remove(path)
+        return len(data)
+
+    async def close(self):
+        """Writes the pending records and a snapshot, and closes the log."""
+        if self.commit_handle:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        if self.commit_task:
+            try:
+                await self.commit_task
+            except asyncio.CancelledError:
+                # The task is cancelled with the others when the server
+                # is stopped, the records it took are written by then.
+                pass
+        if self.pending:
+            await self.commit()
+        await self.write_snapshot()
+        self.segment.close()
@@ -1,33 +1,136 @@
 # -*- coding: utf-8 -*-
 """
 This module contains the functions for sending and receiving messages
-between two sockets.
+between two sockets, and their asyncio stream counterparts.
+Every message is sent as a frame, the length of the message as a 4-byte
+big-endian unsigned integer followed by the message itself.
 """
 
 import socket
+import struct
+import asyncio
+import weakref
 
-header = 64
+header = struct.Struct('>I')
 encoding = 'utf-8'
+# Initial size of the receive buffer of a socket, it grows to fit the
+# largest message received on the socket.
+buffer_size = 64 * 1024
 
+# All the chats of a client are multiplexed over a single connection,
+# every message on it is tagged with its kind and the id of the chat,
+# which is the id (a uuid4 string) of the other user in the chat.
+# The details and the missed messages of a chat, a client sends it with
+# the number of its last message of the chat when it has missed some.
+CHAT = b'C'
+MESSAGE = b'M'  # A message in the chat.
+READ = b'R'  # The chat has been read by the client.
+chat_id_length = 36
 
-def send(message: str | bytes, connection: socket.socket, encode=True):
+
+class ReceiveBuffer:
+    """
+    Buffer for the data received on a socket.
+    The data is received with recv_into on a preallocated buffer, so a
+    single recv can hold several messages and the messages are not
+    built by concatenation.
+    """
+
+    def __init__(self, size: int = buffer_size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # The data that has been received but not read is in
+        # buffer[start:end].
+        self.start = 0
+        self.end = 0
+
+    def read(self, connection: socket.socket, size: int) -> memoryview:
+        """
+        Reads data from the buffer, receiving it from the connection if
+        it has not been received yet.
+        :param connection: Connection to receive the data from.
+        :param size: Number of bytes to read.
+        :return: View of the data, valid until the next read.
+        :raises ConnectionAbortedError: If the connection was closed.
+        """
+        if self.start + size > len(self.buffer):
+            # Move the unread data to the start of the buffer and grow
+            # the buffer if the data still does not fit.
+            unread = self.end - self.start
+            if size > len(self.buffer):
+                buffer = bytearray(max(size, 2 * len(self.buffer)))
+                buffer[:unread] = self.view[self.start:self.end]
+                self.view.release()
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            else:
+                self.view[:unread] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = unread
+        while self.end - self.start < size:
+            received = connection.recv_into(self.view[self.end:])
+            if not received:
+                raise ConnectionAbortedError('The connection was closed.')
+            self.end += received
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return data
+
+
+# Receive buffers of the sockets, they are removed with the sockets.
+receive_buffers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_receive_buffer(connection: socket.socket) -> ReceiveBuffer:
+    """
+    Gets the receive buffer of a socket.
+    :param connection: The socket.
+    :return: The receive buffer of the socket.
     """
+    try:
+        return receive_buffers[connection]
+    except KeyError:
+        receive_buffers[connection] = ReceiveBuffer()
+        return receive_buffers[connection]
+
 
+def send(message: str | bytes, connection: socket.socket, encode=True):
+    """
     Sends a message to the given connection.
-    It is important to note that the message is sent in two parts:
-    1. The length of the message.
-    2. The message itself.
+    The length of the message and the message are sent with a single
+    sendall, so a message is never partially sent.
     :param message: The message to send.
     :param connection: Connection to send the message to
     :param encode: Whether to encode the message or not.
     """
-    message_length = len(message)
-    message_length = str(message_length).encode(encoding)
-    message_length += b' ' * (header - len(message_length))
-    connection.send(message_length)
     if encode:
         message = message.encode(encoding)
-    connection.send(message)
+    connection.sendall(header.pack(len(message)) + message)
+
+
+def tag(kind: bytes, chat_id: str, message: bytes = b'') -> bytes:
+    """
+    Tags a message for the multiplexed chat connection.
+    :param kind: Kind of the message, CHAT, MESSAGE or READ.
+    :param chat_id: Id of the chat the message belongs to.
+    :param message: The message.
+    :return: The tagged message.
+    """
+    return kind + chat_id.encode(encoding) + message
+
+
+def untag(message: bytes | memoryview) -> tuple[bytes, str, bytes | memoryview]:
+    """
+    Splits a message from the multiplexed chat connection into its tag
+    and the message.
+    :param message: The tagged message.
+    :return: Kind of the message, id of the chat and the message, the
+        message is a view if the tagged message is a view.
+    """
+    return (bytes(message[:1]), str(message[1:1 + chat_id_length], encoding),
+            message[1 + chat_id_length:])
 
 
 def receive(connection: socket.socket, decode=True) -> str | bytes:
@@ -36,17 +139,71 @@ def receive(connection: socket.socket, decode=True) -> str | bytes:
     :param connection: Connection to receive the message from.
     :param decode: Whether to decode the message or not.
     :return: The message that was received.
+    :raises ConnectionAbortedError: If the connection was closed.
+    """
+    message = receive_view(connection)
+    if decode:
+        return str(message, encoding)
+    return bytes(message)
+
+
+def receive_view(connection: socket.socket) -> memoryview:
+    """
+    Receives a message from the given connection without copying it out
+    of the receive buffer of the connection, large messages can be
+    parsed (e.g. with pickle.loads) straight from the view.
+    :param connection: Connection to receive the message from.
+    :return: View of the message, it is only valid until the next
+        message is received from the connection.
+    :raises ConnectionAbortedError: If the connection was closed.
+    """
+    buffer = get_receive_buffer(connection)
+    message_length, = header.unpack(buffer.read(connection, header.size))
+    return buffer.read(connection, message_length)
+
+
+async def send_async(message: str | bytes, writer: asyncio.StreamWriter, encode=True):
+    """
+    Sends a message to the given stream, in the same format as send.
+    :param message: The message to send.
+    :param writer: Stream to send the message to.
+    :param encode: Whether to encode the message or not.
+    """
+    if encode:
+        message = message.encode(encoding)
+    writer.write(header.pack(len(message)) + message)
+    await writer.drain()
+
+
+async def send_all_async(messages: list[bytes], writer: asyncio.StreamWriter):
+    """
+    Sends several messages to the given stream with a single write, in
+    the same format as send.
+    The frames are handed to the transport together, so they go out in
+    as few system calls and TCP segments as possible instead of one
+    write for each message. Asyncio sets TCP_NODELAY on its sockets, so
+    the batch is not held back either.
+    :param messages: The messages to send, they are not encoded.
+    :param writer: Stream to send the messages to.
+    """
+    parts = []
+    for message in messages:
+        parts.append(header.pack(len(message)))
+        parts.append(message)
+    writer.writelines(parts)
+    await writer.drain()
+
+
+async def receive_async(reader: asyncio.StreamReader, decode=True) -> str | bytes:
+    """
+    Receives a message sent by send or send_async from the given stream.
+    :param reader: Stream to receive the message from.
+    :param decode: Whether to decode the message or not.
+    :return: The message that was received.
+    :raises asyncio.IncompleteReadError: If the connection was closed.
     """
-    while True:
-        try:
-            message_length = int(connection.recv(header).decode(encoding))
-            length_received = 0
-            message = b''
-            while length_received < message_length:
-                message += connection.recv(message_length - length_received)
-                length_received = len(message)
-            if decode:
-                message = message.decode(encoding)
-            return message
-        except ValueError:
-            pass
+    message_length, = header.unpack(await reader.readexactly(header.size))
+    message = await reader.readexactly(message_length)
+    if decode:
+        message = message.decode(encoding)
+    return message
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for passing the client connections
+between the worker processes of the server.
+The workers share the ports of the server with SO_REUSEPORT so the
+kernel spreads the connections over them, but both connections of a
+client have to be handled by the worker the client belongs to (see
+broker.get_shard). A connection accepted by another worker is passed to
+that worker over a Unix domain socket, as a file descriptor.
+"""
+
+import socket
+import struct
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from dependencies.modules.broker import get_shard  # noqa
+
+# The port a passed connection was accepted on.
+port_format = struct.Struct('>H')
+
+
+class ConnectionHandoff:
+    """Main class for passing the client connections between the workers."""
+
+    def __init__(self, worker: int, sockets: list[tuple[socket.socket, socket.socket]]):
+        """
+        :param worker: Index of this worker.
+        :param sockets: Pairs of connected datagram sockets of all the
+            workers, in order, the connections for a worker are sent on
+            the first socket of its pair and received on the second.
+        """
+        self.worker = worker
+        self.workers = len(sockets)
+        self.senders = [sender for sender, _ in sockets]
+        self.receiver = sockets[worker][1]
+        self.receiver.setblocking(False)
+        self.handlers: dict[int, Callable[[asyncio.StreamReader, asyncio.StreamWriter],
+                                          Awaitable]] = {}
+        # Keeps the tasks handling the connections from being garbage
+        # collected while they run.
+        self.tasks: set[asyncio.Task] = set()
+
+    def start(self, handlers: dict[int, Callable[[asyncio.StreamReader, asyncio.StreamWriter],
+                                                 Awaitable]]):
+        """
+        Starts receiving the connections passed by the other workers.
+        :param handlers: Functions to handle the connections of the
+            clients of this worker by the port they were accepted on,
+            like the one of asyncio.start_server.
+        """
+        self.handlers = handlers
+        asyncio.get_running_loop().add_reader(self.receiver.fileno(), self.receive)
+
+    async def serve(self, port: int):
+        """
+        Accepts the connections on a port shared with the other workers,
+        until cancelled.
+        :param port: The port, it must have a handler, see start.
+        """
+        loop = asyncio.get_running_loop()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(('', port))
+        listener.listen(socket.SOMAXCONN)
+        listener.setblocking(False)
+        try:
+            while True:
+                connection, address = await loop.sock_accept(listener)
+                worker = get_shard(address[0], self.workers)
+                if worker == self.worker:
+                    self.handle(connection, port)
+                    continue
+                try:
+                    socket.send_fds(self.senders[worker], [port_format.pack(port)],
+                                    [connection.fileno()])
+                except OSError as error:
+                    logging.warning(f'Could not pass {address} to worker {worker}: {error}')
+                connection.close()
+        finally:
+            listener.close()
+
+    def receive(self):
+        """Receives the connections passed by the other workers."""
+        while True:
+            try:
+                message, fds, _, _ = socket.recv_fds(self.receiver, port_format.size, 1)
+            except BlockingIOError:
+                return
+            for fd in fds:
+                self.handle(socket.socket(fileno=fd), port_format.unpack(message)[0])
+
+    def handle(self, connection: socket.socket, port: int):
+        """
+        Starts handling a connection of a client of this worker.
+        :param connection: The connection.
+        :param port: The port it was accepted on.
+        """
+        async def handle_connection():
+            try:
+                reader, writer = await asyncio.open_connection(sock=connection)
+            except OSError:
+                connection.close()
+                return
+            await self.handlers[port](reader, writer)
+
+        task = asyncio.create_task(handle_connection())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def close(self):
+        """Stops receiving the connections passed by the other workers."""
+        asyncio.get_running_loop().remove_reader(self.receiver.fileno())
+        for task in list(self.tasks):
+            task.cancel()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the queue of the messages to be
+sent on a connection.
+Every chat connection has a bounded queue and a task that writes the
+messages in it, so a client that is slow to receive only fills its own
+queue instead of stalling the users sending messages to it. The task
+writes all the messages queued since its last write together.
+"""
+
+import asyncio
+import logging
+import weakref
+from collections import deque
+from dependencies.modules.communicator import send_all_async  # noqa
+
+# What to do with a message for a full queue.
+DROP_OLDEST = 'drop-oldest'  # Drop the oldest message in the queue.
+DISCONNECT = 'disconnect'  # Disconnect the client.
+# Wait for space in the queue, this holds up the user sending the message.
+BLOCK = 'block'
+policies = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# Default maximum number of messages in a queue.
+queue_size = 256
+
+# All the open queues, for the metrics.
+queues: weakref.WeakSet = weakref.WeakSet()
+# Totals of the queues that have been closed.
+closed_totals = {'sent': 0, 'dropped': 0, 'disconnected': 0}
+
+
+class OutboundQueue:
+    """Main class for the queue of the messages to be sent on a connection."""
+
+    def __init__(self, writer: asyncio.StreamWriter, size: int = queue_size,
+                 policy: str = DROP_OLDEST, owner: asyncio.Task | None = None):
+        """
+        :param writer: Stream to send the messages to.
+        :param size: Maximum number of messages in the queue.
+        :param policy: What to do with a message for a full queue.
+        :param owner: Task handling the client, it is cancelled if the
+            client is disconnected for a full queue.
+        """
+        if policy not in policies:
+            raise ValueError(f'Unknown overflow policy: {policy}')
+        self.writer = writer
+        self.size = size
+        self.policy = policy
+        self.owner = owner
+        self.messages: deque[bytes] = deque()
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.closed = False
+        # Metrics of the queue.
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.task = asyncio.create_task(self.write_messages())
+        queues.add(self)
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting in the queue."""
+        return len(self.messages)
+
+    async def put(self, message: bytes):
+        """
+        Adds a message to the queue, messages for a closed queue are
+        ignored.
+        :param message: The message.
+        """
+        if self.closed:
+            return
+        if len(self.messages) >= self.size:
+            if self.policy == DROP_OLDEST:
+                self.messages.popleft()
+                self.dropped += 1
+            elif self.policy == DISCONNECT:
+                logging.warning(f'Outbound queue full, disconnecting '
+                                f'{self.writer.get_extra_info("peername")}')
+                self.disconnected += 1
+                self.close()
+                if self.owner:
+                    self.owner.cancel()
+                return
+            else:
+                while len(self.messages) >= self.size and not self.closed:
+                    self.not_full.clear()
+                    await self.not_full.wait()
+                if self.closed:
+                    return
+        self.messages.append(message)
+        self.max_depth = max(self.max_depth, len(self.messages))
+        self.not_empty.set()
+
+    async def write_messages(self):
+        """Sends the messages in the queue until the queue is closed."""
+        try:
+            while True:
+                await self.not_empty.wait()
+                self.not_empty.clear()
+                # The messages queued while the last batch was being
+                # sent, or during the same loop iteration, are sent in
+                # one batch with a single write and drain.
+                while self.messages:
+                    messages = list(self.messages)
+                    self.messages.clear()
+                    self.not_full.set()
+                    await send_all_async(messages, self.writer)
+                    self.sent += len(messages)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Closes the queue and the connection."""
+        if self.closed:
+            return
+        self.closed = True
+        self.messages.clear()
+        # Wake up the senders waiting for space.
+        self.not_full.set()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        self.writer.close()
+        for metric in closed_totals:
+            closed_totals[metric] += getattr(self, metric)
+        queues.discard(self)
+
+
+def get_metrics() -> dict:
+    """
+    Gets the metrics of the outbound queues.
+    :return: Number of open queues, messages waiting in them, the
+        deepest of them, and the totals of the messages sent, messages
+        dropped and clients disconnected for a full queue.
+    """
+    open_queues = list(queues)
+    metrics = {'queues': len(open_queues),
+               'depth': sum(queue.depth for queue in open_queues),
+               'max_depth': max((queue.max_depth for queue in open_queues), default=0)}
+    for metric, total in closed_totals.items():
+        metrics[metric] = total + sum(getattr(queue, metric) for queue in open_queues)
+    return metrics
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the registry of the users connected
+to the server.
+The users are indexed by their id, username and device (address and
+mac), so finding a user does not depend on the number of users.
+"""
+
+import threading
+from dependencies.modules.username_index import UsernameIndex  # noqa
+
+
+class UserRegistry:
+    """Main class for the registry of users on the server."""
+
+    def __init__(self):
+        self.users: dict[str, dict] = {}
+        self.usernames: dict[str, dict] = {}
+        self.devices: dict[tuple[str, str], dict] = {}
+        self.username_index = UsernameIndex()
+        # The registry is used from the event loop, the lock keeps it
+        # consistent if it is also used from other threads.
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.users.values()))
+
+    def add(self, user: dict):
+        """
+        Adds a user to the registry.
+        :param user: The user, with an id, username, address and mac.
+        :raises ValueError: If the id or the username is already taken.
+        """
+        self.add_all([user])
+
+    def add_all(self, users: list[dict]):
+        """
+        Adds users to the registry, the search index is built once for
+        all of them, so it is used when the users are restored.
+        :param users: The users, see add.
+        :raises ValueError: If an id or a username is already taken, the
+            users before it are added.
+        """
+        with self.lock:
+            usernames = []
+            try:
+                for user in users:
+                    if user['id'] in self.users:
+                        raise ValueError(f'Id already registered: {user["id"]}')
+                    if user['username'] in self.usernames:
+                        raise ValueError(f'Username already taken: {user["username"]}')
+                    self.users[user['id']] = user
+                    self.usernames[user['username']] = user
+                    self.devices[(user['address'], user['mac'])] = user
+                    usernames.append(user['username'])
+            finally:
+                self.username_index.add_all(usernames)
+
+    def get(self, _id: str) -> dict | None:
+        """
+        Gets a user by their id.
+        :param _id: Id of the user.
+        """
+        return self.users.get(_id)
+
+    def get_by_username(self, username: str) -> dict | None:
+        """
+        Gets a user by their username.
+        :param username: Username of the user.
+        """
+        return self.usernames.get(username)
+
+    def find(self, address: str, mac: str) -> dict | None:
+        """
+        Finds a user by their address and mac address.
+        :param address: The address of the user.
+        :param mac: The mac address of the user.
+        """
+        return self.devices.get((address, mac))
+
+    def rename(self, user: dict, username: str):
+        """
+        Changes the username of a user.
+        :param user: The user.
+        :param username: The new username.
+        :raises ValueError: If the username is taken by another user.
+        """
+        with self.lock:
+            other_user = self.usernames.get(username)
+            if other_user is not None and other_user is not user:
+                raise ValueError(f'Username already taken: {username}')
+            del self.usernames[user['username']]
+            self.username_index.remove(user['username'])
+            user['username'] = username
+            self.usernames[username] = user
+            self.username_index.add(username)
+
+    def search(self, text: str, limit: int, exclude: str | None = None) -> list[tuple[str, str]]:
+        """
+        Searches for the users whose username contains a text.
+        :param text: The text to search for.
+        :param limit: Maximum number of users to return.
+        :param exclude: Username to leave out of the results.
+        :return: Username and id of the users, see UsernameIndex.search
+            for the order.
+        """
+        with self.lock:
+            return [(username, self.usernames[username]['id'])
+                    for username in self.username_index.search(text, limit, exclude)]
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the class for the search index of the usernames.
+The usernames are kept sorted for the exact and prefix matches, and
+indexed by their trigrams (substrings of three characters) for the
+substring matches, so a search only looks at the usernames that can
+match it.
+"""
+
+import heapq
+import bisect
+import itertools
+
+# Maximum number of usernames inserted into a sorted list one by one,
+# more are appended and the list is sorted, which takes linear time.
+insort_limit = 32
+
+
+def get_trigrams(text: str) -> set[str]:
+    """
+    Gets the trigrams of a text.
+    :param text: The text.
+    :return: The substrings of three characters in the text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_short_grams(trigram: str) -> set[str]:
+    """
+    Gets the substrings of a trigram that are shorter than it.
+    :param trigram: The trigram.
+    :return: The characters and pairs of characters in the trigram.
+    """
+    return set(trigram) | {trigram[:2], trigram[1:]}
+
+
+def merge(usernames: list[str], new_usernames: list[str]):
+    """
+    Adds usernames to a sorted list of usernames, keeping it sorted.
+    :param usernames: The sorted list.
+    :param new_usernames: The usernames to add to it.
+    """
+    if len(new_usernames) <= insort_limit:
+        for username in new_usernames:
+            bisect.insort(usernames, username)
+    else:
+        usernames.extend(new_usernames)
+        usernames.sort()
+
+
+class UsernameIndex:
+    """Main class for the search index of the usernames."""
+
+    def __init__(self):
+        # The usernames, and the usernames by their trigrams, are kept in
+        # sorted lists.
+        self.usernames: list[str] = []
+        self.trigrams: dict[str, list[str]] = {}
+        # Usernames that are too short to have a trigram.
+        self.short_usernames: list[str] = []
+        # Trigrams by the shorter substrings in them, for the searches
+        # that are shorter than a trigram.
+        self.short_grams: dict[str, set[str]] = {}
+        # The usernames that were added are merged into the lists when
+        # they are used, so many usernames are sorted at once, see sort.
+        self.new_usernames: list[str] = []
+        self.new_trigrams: dict[str, list[str]] = {}
+
+    def add(self, username: str):
+        """
+        Adds a username to the index.
+        :param username: The username.
+        """
+        self.new_usernames.append(username)
+        trigrams = get_trigrams(username)
+        if not trigrams:
+            bisect.insort(self.short_usernames, username)
+        for trigram in trigrams:
+            if trigram not in self.trigrams:
+                self.trigrams[trigram] = []
+                for gram in get_short_grams(trigram):
+                    self.short_grams.setdefault(gram, set()).add(trigram)
+            self.new_trigrams.setdefault(trigram, []).append(username)
+
+    def add_all(self, usernames: list[str]):
+        """
+        Adds many usernames to the index, every list is sorted once for
+        all of them, so it is used to build the index when the users
+        are restored.
+        :param usernames: The usernames.
+        """
+        for username in usernames:
+            self.add(username)
+        self.sort()
+
+    def sort(self):
+        """
+        Merges the usernames that were added into the sorted lists.
+        """
+        if self.new_usernames:
+            merge(self.usernames, self.new_usernames)
+            self.new_usernames = []
+        for trigram, usernames in self.new_trigrams.items():
+            merge(self.trigrams[trigram], usernames)
+        self.new_trigrams.clear()
+
+    def remove(self, username: str):
+        """
+        Removes a username from the index.
+        :param username: The username.
+        """
+        self.sort()
+        trigrams = get_trigrams(username)
+        lists = [self.trigrams[trigram] for trigram in trigrams if trigram in self.trigrams]
+        for usernames in [self.usernames, self.short_usernames] + lists:
+            i = bisect.bisect_left(usernames, username)
+            if i < len(usernames) and usernames[i] == username:
+                del usernames[i]
+        for trigram in trigrams:
+            if trigram in self.trigrams and not self.trigrams[trigram]:
+                del self.trigrams[trigram]
+                for gram in get_short_grams(trigram):
+                    self.short_grams[gram].discard(trigram)
+                    if not self.short_grams[gram]:
+                        del self.short_grams[gram]
+
+    def search(self, text: str, limit: int, exclude: str | None = None) -> list[str]:
+        """
+        Searches for the usernames that contain a text.
+        :param text: The text to search for.
+        :param limit: Maximum number of usernames to return.
+        :param exclude: Username to leave out of the results.
+        :return: The username equal to the text first, then the
+            usernames starting with the text, then the other usernames
+            containing the text, both in order.
+        """
+        results: list[str] = []
+        if not text or limit <= 0:
+            return results
+        self.sort()
+
+        # The exact match is the first username starting with the text,
+        # as the usernames are sorted.
+        i = bisect.bisect_left(self.usernames, text)
+        while (len(results) < limit and i < len(self.usernames)
+               and self.usernames[i].startswith(text)):
+            if self.usernames[i] != exclude:
+                results.append(self.usernames[i])
+            i += 1
+        if len(results) == limit:
+            return results
+
+        # Only the usernames with the rarest trigram of the text, or
+        # with a trigram containing the text, can contain the text. They
+        # are walked in order, so the search stops at the last result.
+        if len(text) >= 3:
+            candidates = min((self.trigrams.get(trigram, []) for trigram in get_trigrams(text)),
+                             key=len)
+        else:
+            # A username is in the lists of all its trigrams that
+            # contain the text, they are merged in order without it
+            # being repeated.
+            candidates = (username for username, _ in itertools.groupby(heapq.merge(
+                self.short_usernames,
+                *(self.trigrams[trigram] for trigram in self.short_grams.get(text, ())))))
+        for username in candidates:
+            if text in username and not username.startswith(text) and username != exclude:
+                results.append(username)
+                if len(results) == limit:
+                    break
+        return results
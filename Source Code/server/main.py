@@ -3,192 +3,623 @@
 This is the main file for the server,
 It handles all the connections with the clients and create chats
 between two clients, The user data and chats are deleted when the
-server is closed.
+server is closed, unless the server is started with a folder to store
+them in (--store).
+All the connections are handled by a single asyncio event loop, so the
+number of threads does not grow with the number of connections.
+The messages to a client are sent through a bounded queue on its chat
+connection, what happens when it is full is set with --overflow.
+On platforms with SO_REUSEPORT and Unix domain sockets, the server can
+be started with several worker processes (--workers) to use more than
+one core. Every worker has the users whose address is sharded to it,
+and a broker in the main process connects the users of different
+workers, see broker.Broker.
 """
 
+import os
 import uuid
+import signal
 import socket
-import pickle
+import argparse
 import logging
-from dependencies.modules.communicator import send, receive
-from dependencies.modules.exceptionalthread import ThreadWithExc
+import asyncio
+import multiprocessing
+from dependencies.modules.communicator import send_async, receive_async, untag
 from dependencies.modules.chat import Chat
+from dependencies.modules.user_registry import UserRegistry
+from dependencies.modules.chat_store import ChatStore, USER_RECORD, user_fields
+from dependencies.modules import outbound_queue
+from dependencies.modules.outbound_queue import OutboundQueue
+from dependencies.modules import broker as broker_frames
+from dependencies.modules.broker import Broker, get_shard, MESSAGE_RELAY
+from dependencies.modules.broker_link import BrokerLink
+from dependencies.modules.connection_handoff import ConnectionHandoff
+from dependencies.modules import codec
 
 
-users: list[dict] = []
-threads: list[ThreadWithExc] = []
+users = UserRegistry()
+# Maximum number of users returned by a username search.
+search_limit = 50
 chats: list[Chat] = []
-
-# This is the main connection of the server with the client that
-# handles the creation of new chats, searching username, and changing
-# client username.
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(('', 8080))
-server.listen()
-
-# This is the connection of the server with the client that helps
-# connect two clients temporarily before a chat connection is created.
-server_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_.bind(('', 9090))
-server_.listen()
+store: ChatStore | None = None
+# Connections to the second server that are waiting to be paired with
+# the client connection from the same address, and the number of client
+# connections waiting for one, by address.
+pending_connections: dict[str, asyncio.Queue] = {}
+pairing_clients: dict[str, int] = {}
+# Maximum number of messages waiting to be sent on a chat connection,
+# and what to do with a message when there are that many.
+queue_size = outbound_queue.queue_size
+overflow_policy = outbound_queue.DROP_OLDEST
+# Time in seconds between logging the metrics of the outbound queues.
+metrics_interval = 60
+# Number of worker processes, index of this worker, and the connection
+# to the broker if there are several workers.
+workers = 1
+worker_id = 0
+broker: BrokerLink | None = None
+# The users of other workers that have chats with users of this worker.
+remote_users: dict[str, dict] = {}
+# Time in seconds to wait for the workers to stop.
+stop_timeout = 10
 
 logging.basicConfig(format=f'%(asctime)s [%(levelname)s] %(message)s')
 logging.getLogger().setLevel(logging.INFO)
 
 
-def get_username(_connection: socket.socket) -> str:
+async def get_username(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                       _id: str) -> str:
     """
     Gets the username from a given connection.
-    :param _connection: The connection to get the username from.
+    :param reader: Stream to receive the username from.
+    :param writer: Stream to reply to.
+    :param _id: Id of the user, the username is reserved for them on
+        the other workers.
     :return: The username of the client.
     """
-    username = receive(_connection)
-    if username in [user['username'] for user in users]:
-        send('0', _connection)
-        return get_username(_connection)
-    send('1', _connection)
-    return username
+    while True:
+        username = await receive_async(reader)
+        if users.get_by_username(username) or (broker and not await broker.claim(username, _id)):
+            await send_async('0', writer)
+        else:
+            await send_async('1', writer)
+            return username
 
 
-def find_user(address: str, mac: str) -> dict | None:
+def get_pending_connections(address: str) -> asyncio.Queue:
     """
-    Finds a user by their address and mac address.
-    :param address: The address of the user.
-    :param mac: The mac address of the user.
+    Gets the queue of connections to the second server from an address.
+    :param address: The address of the connections.
     """
-    for user in users:
-        if user['address'] == address and user['mac'] == mac:
-            return user
-    return None
+    if address not in pending_connections:
+        pending_connections[address] = asyncio.Queue()
+    return pending_connections[address]
+
+
+async def get_chat_connection(address: str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """
+    Waits for a connection to the second server from an address to pair
+    with a client connection. The connections of clients that closed
+    them before they were paired are closed and skipped.
+    :param address: The address of the client.
+    :return: Stream to receive from the connection and to send to it.
+    """
+    queue = get_pending_connections(address)
+    pairing_clients[address] = pairing_clients.get(address, 0) + 1
+    try:
+        while True:
+            reader, writer = await queue.get()
+            # The client sends nothing on the connection before it is
+            # paired, so a connection at its end is closed by the client.
+            if not (reader.at_eof() or reader.exception() or writer.is_closing()):
+                return reader, writer
+            writer.close()
+    finally:
+        # The queue is removed once no connection or client waits in it.
+        pairing_clients[address] -= 1
+        if not pairing_clients[address]:
+            del pairing_clients[address]
+            if queue.empty() and pending_connections.get(address) is queue:
+                del pending_connections[address]
+
+
+async def handle_second_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Function to handle a connection with the second server, it is
+    passed on to the client connection from the same address and
+    becomes the chat connection of the client.
+    :param reader: Stream to receive from the connection.
+    :param writer: Stream to send to the connection.
+    """
+    get_pending_connections(writer.get_extra_info('peername')[0]).put_nowait((reader, writer))
+
+
+async def listen_chats(user: dict, reader: asyncio.StreamReader):
+    """
+    Listens to the chat connection of a user and passes the messages
+    on to the chats they are tagged with.
+    :param user: The user to listen to.
+    :param reader: Stream to receive from the chat connection.
+    """
+    try:
+        while True:
+            # The messages are binary ciphertexts so they are not decoded.
+            kind, chat_id, message = untag(await receive_async(reader, False))
+            for chat in user['chats']:
+                if chat.get_other_user(user['id'])['id'] == chat_id:
+                    await chat.receive_message(user, kind, message)
+                    break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+def add_remote_user(details: dict) -> dict:
+    """
+    Adds a user of another worker that has a chat with a user of this
+    worker, or updates their details.
+    :param details: The user details, see user_fields.
+    :return: The user.
+    """
+    user = remote_users.get(details['id'])
+    if user:
+        user.update(details)
+    else:
+        user = dict(details, chats=[], socket=None, remote=True)
+        remote_users[user['id']] = user
+    if store:
+        store.add_user(user)
+    return user
+
+
+async def get_user(_id: str) -> dict | None:
+    """
+    Gets a user of any worker by their id.
+    :param _id: Id of the user.
+    """
+    user = users.get(_id) or remote_users.get(_id)
+    if user or not broker:
+        return user
+    details = await broker.get_user(_id)
+    return add_remote_user(details) if details else None
+
+
+def update_username(user: dict):
+    """
+    Updates the username of a user in their chats.
+    :param user: The user.
+    """
+    for chat in user['chats']:
+        _user = chat.user_1 if chat.user_1['id'] == user['id'] else chat.user_2
+        _user['username'] = user['username']
+
+
+async def add_chat(user_1: dict, user_2: dict) -> Chat:
+    """
+    Creates a chat between two users and connects them to it.
+    :param user_1: The user that started the chat.
+    :param user_2: The other user.
+    :return: The chat.
+    """
+    chat = Chat(user_1.copy(), user_2.copy(), store=store, broker=broker)
+    if store:
+        store.add_chat(user_1['id'], user_2['id'])
+    user_1['chats'].append(chat)
+    user_2['chats'].append(chat)
+    await chat.connect_user(user_1.copy())
+    await chat.connect_user(user_2.copy())
+    chats.append(chat)
+    logging.info(f'New chat({user_1["username"]}, {user_2["username"]})')
+    return chat
+
+
+async def handle_remote_user(_id: str, message: memoryview):
+    """
+    Handles a changed username of a user of another worker.
+    :param _id: Id of the user.
+    :param message: The user details, see USER_RECORD.
+    """
+    if _id in remote_users:
+        update_username(add_remote_user(dict(zip(user_fields, USER_RECORD.loads(message)))))
+
+
+async def handle_remote_chat(_id: str, message: memoryview):
+    """
+    Handles a chat started by a user of another worker.
+    :param _id: Id of the user of this worker the chat was started with.
+    :param message: The user that started the chat, see USER_RECORD.
+    """
+    user_2 = users.get(_id)
+    if user_2:
+        await add_chat(add_remote_user(dict(zip(user_fields, USER_RECORD.loads(message)))),
+                       user_2)
+
+
+async def handle_remote_message(_id: str, message: memoryview):
+    """
+    Handles a message in a chat with a user of another worker.
+    :param _id: Id of the user of this worker in the chat.
+    :param message: The other user and the message, see MESSAGE_RELAY.
+    """
+    user = users.get(_id)
+    if not user:
+        return
+    user_1, chat_message = MESSAGE_RELAY.loads(message)
+    for chat in user['chats']:
+        if chat.get_other_user(_id)['id'] == user_1:
+            await chat.receive_relayed_message(chat_message)
+            break
 
 
-def handle_client(client: socket.socket, address: tuple[str, int]):
+async def handle_client(client: asyncio.StreamReader, writer: asyncio.StreamWriter):
     """
     Function to handle a client connection.
     It handles the creation of new chats, searching username, and
     changing client username. This function is called when a new
-    client connects to the server and is run in a separate thread to
-    allow the main thread to accept new connections.
-    :param client: The client socket.
-    :param address: Address of the client.
+    client connects to the server and is run as a separate task to
+    allow the server to accept new connections.
+    :param client: Stream to receive from the client.
+    :param writer: Stream to send to the client.
     """
+    address = writer.get_extra_info('peername')
+    user: dict | None = None
+    new_id: str | None = None
+    chat_queue: OutboundQueue | None = None
+    listen_chats_task: asyncio.Task | None = None
     try:
-        mac = receive(client)
+        mac = await receive_async(client)
         # The user and their chat are identified by their
         # ip address and mac.
-        user = find_user(address[0], mac)
+        user = users.find(address[0], mac)
         if user:
-            send('1', client)
+            await send_async('1', writer)
             logging.info(f'User reconnected({address}, {user["username"]})')  # noqa
         else:
             # Send 0 to indicate that the user is new.
-            send('0', client)
-            username = get_username(client)
-            user_public_key = receive(client)
-            user = {'id': str(uuid.uuid4()),
+            await send_async('0', writer)
+            new_id = str(uuid.uuid4())
+            username = await get_username(client, writer, new_id)
+            user_public_key = await receive_async(client)
+            user = {'id': new_id,
                     'address': address[0],
                     'mac': mac,
                     'username': username,
                     'key': user_public_key,
                     'chats': []
                     }
-            users.append(user)
+            users.add(user)
+            if store:
+                store.add_user(user)
+            if broker:
+                await broker.add_user(user)
             logging.info(f'New user({address}, {username})')
 
-        while True:
-            # Wait for the client to connect to the second server.
-            _connection = server_.accept()
-            if _connection[1][0] == address[0]:
-                break
-        user['socket'] = _connection[0]
+        # A reconnecting user replaces their previous connection, which
+        # is cancelled so its tasks and sockets are not left behind
+        # when the client did not disconnect cleanly.
+        if user.get('task'):
+            user['task'].cancel()
+        user['task'] = asyncio.current_task()
 
-        send(pickle.dumps((user['username'], user['id'])), client, False)
+        # Wait for the client to connect to the second server, all the
+        # chats of the user are multiplexed over this connection.
+        chat_reader, chat_writer = await get_chat_connection(address[0])
+        chat_queue = OutboundQueue(chat_writer, queue_size, overflow_policy,
+                                   asyncio.current_task())
+        user['socket'] = chat_queue
+        listen_chats_task = asyncio.create_task(listen_chats(user, chat_reader))
 
-        # Connect the user to their existing chats.
+        await send_async(codec.USER.dumps((user['username'], user['id'])), writer, False)
+
+        # Connect the user to their existing chats, the client tells
+        # which messages of each chat it already has.
+        last_seen = dict(codec.SYNC.loads(await receive_async(client, False)))
         for chat in user['chats']:
-            chat.connect_user(user.copy())
+            await chat.connect_user(
+                user.copy(), last_seen.get(chat.get_other_user(user['id'])['id'], 0))
 
         while True:
             # Wait for the client to choose an option.
-            message = receive(client)
+            message = await receive_async(client)
             # 0: Create new chat
             if message == '0':
-                chat_with = receive(client)
-                for user_2 in users:
-                    if user_2['id'] == chat_with:
-                        chat = Chat(user.copy(), user_2.copy())
-                        user['chats'].append(chat)
-                        user_2['chats'].append(chat)
-                        chat.connect_user(user.copy())
-                        chat.connect_user(user_2.copy())
-                        chats.append(chat)
-                        logging.info(f'New chat({user["username"]}, {user_2["username"]})')
-                        break
+                chat_with = await receive_async(client)
+                user_2 = await get_user(chat_with)
+                if user_2:
+                    await add_chat(user, user_2)
+                    # The worker of the other user makes its own copy
+                    # of the chat.
+                    if user_2.get('remote'):
+                        await broker.add_chat(user, user_2['id'])
             # 1: Search username
             elif message == '1':
-                username = receive(client)
-                possible_users: list[tuple] = []
-                for user_2 in users:
-                    if (username in user_2['username'] and
-                            not user_2['username'] == user['username']):
-                        _user = (user_2['username'], user_2['id'])
-                        if username == user_2['username']:
-                            possible_users.insert(0, _user)
-                        else:
-                            possible_users.append(_user)
-                send(pickle.dumps(possible_users), client, False)
+                username = await receive_async(client)
+                if broker:
+                    possible_users = await broker.search(username, search_limit,
+                                                         user['username'])
+                else:
+                    possible_users = users.search(username, search_limit, user['username'])
+                await send_async(codec.USERS.dumps(possible_users), writer, False)
             # 2: Change username
             elif message == '2':
                 old_username = user['username']
-                new_username = get_username(client)
-                user['username'] = new_username
-                for chat in user['chats']:
-                    _user = chat.user_1 if chat.user_1['id'] == user['id'] else chat.user_2
-                    _user['username'] = new_username
-                send(user['username'], client)
+                new_username = await get_username(client, writer, user['id'])
+                users.rename(user, new_username)
+                if store:
+                    store.add_user(user)
+                if broker:
+                    await broker.add_user(user)
+                update_username(user)
+                await send_async(user['username'], writer)
                 logging.info(f'Username changed({old_username}, {new_username})')
             # 3: Disconnect
             elif message == '3':
                 logging.info(f'User disconnected({user["username"]})')
                 break
-    except SystemExit:
+    except (asyncio.CancelledError, asyncio.IncompleteReadError, ConnectionError):
         pass
     except Exception as error:
         logging.warning(error)
+    finally:
+        # Free the username reserved for a new user that did not finish
+        # connecting.
+        if broker and new_id and not user:
+            broker.release(new_id)
+        if user and user.get('task') is asyncio.current_task():
+            user['task'] = None
+        if listen_chats_task:
+            listen_chats_task.cancel()
+        if chat_queue:
+            for chat in user['chats']:
+                chat.disconnect_user(user, chat_queue)
+            if user['socket'] is chat_queue:
+                user['socket'] = None
+            chat_queue.close()
+        writer.close()
+
+
+async def log_metrics():
+    """Logs the metrics of the outbound queues when they change."""
+    last_metrics = None
+    while True:
+        await asyncio.sleep(metrics_interval)
+        metrics = outbound_queue.get_metrics()
+        if metrics != last_metrics:
+            logging.info('Outbound queues(' + ', '.join(
+                f'{name}: {value}' for name, value in metrics.items()) + ')')
+            last_metrics = metrics
 
 
-def listen_clients():
+def restore(_store: ChatStore):
     """
-    Listens to the clients for a connection.
+    Restores the users and chats from a store.
+    :param _store: The store.
     """
+    stored_users, stored_chats = _store.load()
+    local_users = []
+    for user in stored_users.values():
+        # The store of a worker has the users of the other workers that
+        # have chats with its users.
+        if get_shard(user['address'], workers) == worker_id:
+            local_users.append(dict(user, chats=[], socket=None))
+        else:
+            remote_users[user['id']] = dict(user, chats=[], socket=None, remote=True)
+    users.add_all(local_users)
+    for (user_1_id, user_2_id), stored_chat in stored_chats.items():
+        user_1 = users.get(user_1_id) or remote_users[user_1_id]
+        user_2 = users.get(user_2_id) or remote_users[user_2_id]
+        chat = Chat(user_1.copy(), user_2.copy(), store=_store, broker=broker)
+        # The store keeps its own copy of the history for its snapshots,
+        # sharing it would add every new message to it twice.
+        for message in stored_chat['chat']:
+            chat.chat.append(message)
+        chat.user_1_unread, chat.user_2_unread = stored_chat['unread']
+        user_1['chats'].append(chat)
+        user_2['chats'].append(chat)
+        chats.append(chat)
+
+
+async def main(store_path: str | None = None, broker_socket: socket.socket | None = None,
+               handoff: ConnectionHandoff | None = None):
+    """
+    Starts the servers and serves the clients until cancelled.
+    :param store_path: Folder to store the users and chats in.
+    :param broker_socket: Connection to the broker, if the server has
+        several workers and this is one of them.
+    :param handoff: Passes the connections between the workers.
+    """
+    global store, broker
+    if broker_socket:
+        broker = BrokerLink(*await asyncio.open_connection(sock=broker_socket), {
+            broker_frames.USER: handle_remote_user,
+            broker_frames.CHAT: handle_remote_chat,
+            broker_frames.MESSAGE: handle_remote_message})
+    if store_path:
+        store = ChatStore(store_path)
+        restore(store)
     try:
-        while True:
-            # Wait for new connections.
-            connection = server.accept()
-            # Create a new thread to handle the connection.
-            _thread = ThreadWithExc(target=handle_client, args=connection)
-            _thread.start()
-            threads.append(_thread)
-    except SystemExit:
+        if handoff:
+            await serve_worker(handoff)
+        else:
+            # This is the main connection of the server with the client
+            # that handles the creation of new chats, searching username,
+            # and changing client username.
+            server = await asyncio.start_server(handle_client, '', 8080,
+                                                backlog=socket.SOMAXCONN)
+            # This is the chat connection of the server with the client,
+            # all the chats of the client are multiplexed over it.
+            server_ = await asyncio.start_server(handle_second_connection, '', 9090,
+                                                 backlog=socket.SOMAXCONN)
+            logging.info(f'Server is running...')
+            async with server, server_:
+                await asyncio.gather(server.serve_forever(), server_.serve_forever(),
+                                     log_metrics())
+    finally:
+        for _chat in chats:
+            _chat.__delete__()
+        if store:
+            await store.close()
+
+
+async def serve_worker(handoff: ConnectionHandoff):
+    """
+    Serves the clients of this worker until cancelled or disconnected
+    from the broker.
+    :param handoff: Passes the connections between the workers.
+    """
+    # The worker is stopped by the main process with SIGTERM.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    for user in users:
+        await broker.add_user(user)
+    handoff.start({8080: handle_client, 9090: handle_second_connection})
+    serving = asyncio.gather(handoff.serve(8080), handoff.serve(9090), log_metrics())
+    logging.info(f'Worker is running...')
+    try:
+        await asyncio.wait([serving, broker.task], return_when=asyncio.FIRST_COMPLETED)
+        if serving.done():
+            await serving
+    finally:
+        serving.cancel()
+        try:
+            await serving
+        except asyncio.CancelledError:
+            pass
+        handoff.close()
+        broker.close()
+
+
+def run_worker(worker: int, links: list[tuple[socket.socket, socket.socket]],
+               handoff_sockets: list[tuple[socket.socket, socket.socket]],
+               store_path: str | None):
+    """
+    Runs a worker process of the server.
+    :param worker: Index of the worker.
+    :param links: Pairs of connected sockets of the broker and the
+        workers, in order.
+    :param handoff_sockets: Pairs of connected sockets to pass the
+        connections to the workers, see ConnectionHandoff.
+    :param store_path: Folder of the store of the server.
+    """
+    global worker_id
+    worker_id = worker
+    # The sockets of the broker and the other workers are closed, so the
+    # broker sees the worker disconnect if it stops.
+    for i, (broker_socket, worker_socket) in enumerate(links):
+        broker_socket.close()
+        if i != worker:
+            worker_socket.close()
+    for i, (_, receiver) in enumerate(handoff_sockets):
+        if i != worker:
+            receiver.close()
+    # The main process stops the workers, see serve_workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger().handlers[0].setFormatter(logging.Formatter(
+        f'%(asctime)s [%(levelname)s] [worker {worker}] %(message)s'))
+    try:
+        asyncio.run(main(store_path and os.path.join(store_path, f'worker-{worker}'),
+                         links[worker][1], ConnectionHandoff(worker, handoff_sockets)))
+    except asyncio.CancelledError:
         pass
-    except Exception as error:
-        logging.warning(error)
+
+
+def serve_workers(store_path: str | None):
+    """
+    Runs the server with several worker processes and the broker
+    between them, until interrupted or a worker stops.
+    :param store_path: Folder to store the users and chats in, every
+        worker stores its users in a folder in it.
+    """
+    links = [socket.socketpair() for _ in range(workers)]
+    handoff_sockets = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                       for _ in range(workers)]
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker,
+                                 args=(worker, links, handoff_sockets, store_path))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for _, worker_socket in links:
+        worker_socket.close()
+    for sender, receiver in handoff_sockets:
+        sender.close()
+        receiver.close()
+
+    async def run_broker():
+        broker_ = Broker(workers)
+        try:
+            await broker_.serve([broker_socket for broker_socket, _ in links])
+        finally:
+            # The workers are stopped before the broker is closed, so
+            # they do not see it disconnect while they stop.
+            await asyncio.to_thread(stop_workers, processes)
+            broker_.close()
+
+    asyncio.run(run_broker())
+
+
+def stop_workers(processes: list[multiprocessing.Process]):
+    """
+    Stops the worker processes, they save their stores when they are
+    stopped with SIGTERM.
+    :param processes: The worker processes.
+    """
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(stop_timeout)
+        if process.is_alive():
+            process.kill()
+
+
+def get_store_workers(store_path: str) -> int:
+    """
+    Gets the number of workers a store was made with, the users are
+    stored by the worker they belong to so it cannot be changed.
+    :param store_path: Folder of the store, a new store is made for the
+        current number of workers.
+    """
+    path = os.path.join(store_path, 'workers')
+    if os.path.exists(path):
+        with open(path) as file:
+            return int(file.read())
+    # A store made before the number was kept has a single worker.
+    store_workers = 1 if os.path.exists(os.path.join(store_path, 'log')) else workers
+    os.makedirs(store_path, exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(str(store_workers))
+    return store_workers
 
 
 if __name__ == '__main__':
-    logging.info(f'Server is running...')
+    parser = argparse.ArgumentParser(description='PeerChat server')
+    parser.add_argument('--store', help='folder to store the users and chats in, so they '
+                                        'are restored when the server restarts')
+    parser.add_argument('--queue-size', type=int, default=queue_size,
+                        help='maximum number of messages waiting to be sent to a client')
+    parser.add_argument('--overflow', choices=outbound_queue.policies, default=overflow_policy,
+                        help='what to do with a message to a client whose queue is full: '
+                             'drop the oldest message, disconnect the client, or wait')
+    parser.add_argument('--workers', type=int, default=workers,
+                        help='number of worker processes, more than one needs SO_REUSEPORT '
+                             'and Unix domain sockets')
+    args = parser.parse_args()
+    queue_size = args.queue_size
+    overflow_policy = args.overflow
+    workers = args.workers
+    if workers < 1:
+        parser.error('there must be at least one worker')
+    if workers > 1 and not all(hasattr(socket, name)
+                               for name in ('SO_REUSEPORT', 'AF_UNIX', 'send_fds')):
+        parser.error('several workers are not supported on this platform')
+    if args.store:
+        store_workers = get_store_workers(args.store)
+        if store_workers != workers:
+            parser.error(f'the store was made with {store_workers} workers')
     try:
-        thread = ThreadWithExc(target=listen_clients)
-        thread.start()
-        threads.append(thread)
-        while True:
-            pass
+        if workers > 1:
+            serve_workers(args.store)
+        else:
+            asyncio.run(main(args.store))
     except KeyboardInterrupt:
         logging.info('Server is shutting down...')
-        for thread in threads:
-            thread.raiseExc(SystemExit)
-        for _chat in chats:
-            _chat.__delete__()
-        server.close()
-        server_.close()
-        logging.info('Server has been stopped.')
+    logging.info('Server has been stopped.')